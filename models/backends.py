@@ -0,0 +1,155 @@
+# Inference backends for the pose pipeline
+#
+# A backend takes a (b, 3, h, w) float input tensor and returns the raw decoded predictions (b, n, 6 + 3 * nkpt) that
+# non_max_suppression_kpt() expects, on the CPU or the model device. Backends with nms = True run NMS in the graph and
+# return its result directly: a list of (n, 6 + 3 * nkpt) detections per image.
+#
+# Usage (benchmark):
+#   $ python models/backends.py --weights yolov7-w6-pose.pt --img-size 384 640 --backends torch onnxruntime
+
+import argparse
+import logging
+import os
+import sys
+import time
+from copy import deepcopy
+
+sys.path.append('./')  # to run '$ python *.py' files in subdirectories
+
+import torch
+import torch.nn as nn
+
+from models.experimental import End2End, attempt_load, trace_cache_file
+from utils.general import check_requirements, non_max_suppression_kpt_batched, set_logging
+
+logger = logging.getLogger(__name__)
+
+
+class TorchBackend:
+    # Eager (or traced, see CachedTracedModel) PyTorch model
+    name = 'torch'
+    nms = False
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, im):
+        return self.model(im)[0]
+
+
+class Predictions(nn.Module):
+    # Export wrapper: the decoded predictions only, without the per-level raw maps
+    def __init__(self, model):
+        super(Predictions, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)[0]
+
+
+class OnnxRuntimeBackend:
+    # ONNX Runtime on the CPU execution provider. The model is exported to onnx_file on first use for the fixed
+    # (b, 3, h, w) input shape, since the decode grids are baked into the graph. With nms=dict(conf_thres, iou_thres,
+    # max_det) the export is an End2End graph with NonMaxSuppression that also carries the keypoints.
+    name = 'onnxruntime'
+
+    def __init__(self, model, onnx_file, shape, opset=12, nms=None):
+        check_requirements(('onnxruntime',))
+        import onnxruntime as ort
+
+        self.nms = nms is not None
+        if not os.path.exists(onnx_file):
+            self.export(model, onnx_file, shape, opset, nms)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(onnx_file), options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0].name
+        self.shape = torch.Size(shape)
+
+    @staticmethod
+    def export(model, f, shape, opset=12, nms=None):
+        model = deepcopy(model).cpu().float().eval()
+        detect = model.model[-1]
+        detect.sparse_kpt = False  # data-dependent shapes, the dense head exports as one static graph
+        if nms:
+            model = End2End(model, nms['max_det'], nms['iou_thres'], nms['conf_thres'], max_wh=4096)
+            outputs = ['num_dets', 'dets']  # (b,), (b, max_det, 6 + 3 * nkpt) [xyxy, conf, cls, kpts]
+        else:
+            model = Predictions(model)
+            outputs = ['output']
+        t = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(f)), exist_ok=True)
+        tmp = f'{f}.{os.getpid()}.tmp'
+        with torch.no_grad():
+            torch.onnx.export(model, torch.zeros(shape), tmp, opset_version=opset,
+                              input_names=['images'], output_names=outputs)
+        os.replace(tmp, f)
+        logger.info(f'Exported {f} in {time.time() - t:.1f}s')
+
+    def __call__(self, im):
+        n = len(im)
+        assert n <= self.shape[0] and im.shape[1:] == self.shape[1:], \
+            f'onnxruntime backend exported for input {tuple(self.shape)}, got {tuple(im.shape)}'
+        if n < self.shape[0]:  # short batch (end of stream, gated frames), padded to the exported batch size
+            im = torch.cat((im, im.new_zeros((self.shape[0] - n, *im.shape[1:]))))
+        y = self.session.run(None, {self.input: im.cpu().float().numpy()})
+        if self.nms:
+            num_dets, dets = y
+            return [torch.from_numpy(d[:k]) for d, k in zip(dets[:n], num_dets[:n])]
+        return torch.from_numpy(y[0][:n])
+
+
+BACKENDS = 'torch', 'onnxruntime', 'onnxruntime-nms'
+
+
+def load_backend(name, model, weights, shape, cache_dir='.', conf_thres=0.25, iou_thres=0.65, max_det=300):
+    # Backend 'name' serving inputs of shape (b, 3, h, w) for the model loaded from weights. The NMS settings are
+    # used by backends that run NMS in the graph
+    weights = weights[0] if isinstance(weights, list) else weights
+    if name == 'torch':
+        return TorchBackend(model)
+    elif name == 'onnxruntime':
+        return OnnxRuntimeBackend(model, trace_cache_file(weights, cache_dir, shape, 'cpu', suffix='.onnx'), shape)
+    elif name == 'onnxruntime-nms':
+        nms = dict(conf_thres=conf_thres, iou_thres=iou_thres, max_det=max_det)
+        f = trace_cache_file(weights, cache_dir, shape, 'cpu', suffix=f'-nms{max_det}-{iou_thres}-{conf_thres}.onnx')
+        return OnnxRuntimeBackend(model, f, shape, nms=nms)
+    raise ValueError(f'unknown backend {name}, choose from {BACKENDS}')
+
+
+def benchmark(weights, img_size=(384, 640), batch_size=1, backends=BACKENDS, runs=50, cache_dir='deploy_cache'):
+    # Mean latency of model forward and NMS per backend on the same random input batch
+    model = attempt_load(weights, map_location='cpu', cache_dir=cache_dir)
+    shape = (batch_size, 3, *img_size)
+    im = torch.rand(shape)
+    nc, nkpt = model.yaml['nc'], model.yaml['nkpt']
+    print(f"{'backend':>12}{'forward ms':>12}{'NMS ms':>10}{'FPS':>8}{'detections':>12}")
+    for name in backends:
+        backend = load_backend(name, model, weights, shape, cache_dir)
+        with torch.no_grad():
+            for _ in range(3):  # warmup
+                backend(im)
+            t_forward = t_nms = 0.
+            for _ in range(runs):
+                t0 = time.time()
+                pred = backend(im)
+                t1 = time.time()
+                out = pred if backend.nms else non_max_suppression_kpt_batched(pred, 0.25, 0.65, nc=nc, nkpt=nkpt)
+                t_forward += t1 - t0
+                t_nms += time.time() - t1
+        dt = (t_forward + t_nms) / runs
+        print(f'{name:>12}{t_forward / runs * 1E3:>12.1f}{t_nms / runs * 1E3:>10.1f}{batch_size / dt:>8.1f}'
+              f'{sum(len(o) for o in out):>12}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='yolov7-w6-pose.pt', help='model.pt path')
+    parser.add_argument('--img-size', nargs=2, type=int, default=[384, 640], help='input height, width')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), help='backends to compare')
+    parser.add_argument('--runs', type=int, default=50, help='timed runs per backend')
+    parser.add_argument('--deploy-cache', type=str, default='deploy_cache', help='dir of fused/exported models')
+    opt = parser.parse_args()
+    set_logging()
+    benchmark(opt.weights, opt.img_size, opt.batch_size, opt.backends, opt.runs, opt.deploy_cache)
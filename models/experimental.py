@@ -1,9 +1,14 @@
 import numpy as np
+import os
 import random
+import time
+from pathlib import Path
+
 import torch
 import torch.nn as nn
 
 from models.common import Conv, DWConv
+from utils.general import file_hash
 from utils.google_utils import attempt_download
 
 
@@ -95,7 +100,7 @@ class ORT_NMS(torch.autograd.Function):
                 score_threshold=torch.tensor([0.25])):
         device = boxes.device
         batch = scores.shape[0]
-        num_det = random.randint(0, 100)
+        num_det = random.randint(0, min(100, int(max_output_boxes_per_class)))
         batches = torch.randint(0, batch, (num_det,)).sort()[0].to(device)
         idxs = torch.arange(100, 100 + num_det).to(device)
         zeros = torch.zeros((num_det,), dtype=torch.int64).to(device)
@@ -158,18 +163,22 @@ class TRT_NMS(torch.autograd.Function):
 
 class ONNX_ORT(nn.Module):
     '''onnx module with ONNX-Runtime NMS operation.'''
-    def __init__(self, max_obj=100, iou_thres=0.45, score_thres=0.25, max_wh=640, device=None):
+    def __init__(self, max_obj=100, iou_thres=0.45, score_thres=0.25, max_wh=640, device=None, nkpt=None):
         super().__init__()
         self.device = device if device else torch.device("cpu")
         self.max_obj = torch.tensor([max_obj]).to(device)
         self.iou_threshold = torch.tensor([iou_thres]).to(device)
         self.score_threshold = torch.tensor([score_thres]).to(device)
         self.max_wh = max_wh # if max_wh != 0 : non-agnostic else : agnostic
+        self.nkpt = nkpt # keypoints per detection, gathered along with the selected boxes when set
         self.convert_matrix = torch.tensor([[1, 0, 1, 0], [0, 1, 0, 1], [-0.5, 0, 0.5, 0], [0, -0.5, 0, 0.5]],
                                            dtype=torch.float32,
                                            device=self.device)
 
     def forward(self, x):
+        if self.nkpt:
+            kpts = x[:, :, -3 * self.nkpt:]
+            x = x[:, :, :-3 * self.nkpt]
         boxes = x[:, :, :4]
         conf = x[:, :, 4:5]
         scores = x[:, :, 5:]
@@ -184,9 +193,22 @@ class ONNX_ORT(nn.Module):
         selected_boxes = boxes[X, Y, :]
         selected_categories = category_id[X, Y, :].float()
         selected_scores = max_score[X, Y, :]
+        if self.nkpt:
+            det = torch.cat([selected_boxes, selected_scores, selected_categories, kpts[X, Y, :]], 1)
+            return self.pad(X, det, x.shape[0])
         X = X.unsqueeze(1).float()
         return torch.cat([X, selected_boxes, selected_categories, selected_scores], 1)
 
+    def pad(self, X, det, batch):
+        # Scatter the selected rows det (n, 6 + 3 * nkpt) to fixed (batch, max_obj, 6 + 3 * nkpt) slots, zero padded.
+        # NonMaxSuppression returns each image's indices together, so a row's slot is its rank among them.
+        i = torch.arange(X.shape[0], device=X.device)
+        slot = ((X[None, :] == X[:, None]) & (i[None, :] < i[:, None])).sum(1)
+        out = torch.zeros((batch, int(self.max_obj), det.shape[1]), dtype=det.dtype, device=det.device)
+        out[X, slot] = det
+        num_det = (X[None, :] == torch.arange(batch, device=X.device)[:, None]).sum(1)
+        return num_det, out
+
 class ONNX_TRT(nn.Module):
     '''onnx module with TensorRT NMS operation.'''
     def __init__(self, max_obj=100, iou_thres=0.45, score_thres=0.25, max_wh=None ,device=None):
@@ -221,8 +243,13 @@ class End2End(nn.Module):
         assert isinstance(max_wh,(int)) or max_wh is None
         self.model = model.to(device)
         self.model.model[-1].end2end = True
-        self.patch_model = ONNX_TRT if max_wh is None else ONNX_ORT
-        self.end2end = self.patch_model(max_obj, iou_thres, score_thres, max_wh, device)
+        nkpt = getattr(self.model.model[-1], 'nkpt', None)  # pose head: keypoints travel with the selected boxes
+        if nkpt:
+            assert max_wh is not None, 'keypoint End2End export needs the ONNX-Runtime NMS (set max_wh)'
+            self.end2end = ONNX_ORT(max_obj, iou_thres, score_thres, max_wh, device, nkpt)
+        else:
+            self.patch_model = ONNX_TRT if max_wh is None else ONNX_ORT
+            self.end2end = self.patch_model(max_obj, iou_thres, score_thres, max_wh, device)
         self.end2end.eval()
 
     def forward(self, x):
@@ -234,13 +261,49 @@ class End2End(nn.Module):
 
 
 
-def attempt_load(weights, map_location=None):
+def deploy_cache_file(w, cache_dir):
+    # Deploy cache entry of weights file w: keyed by the file's content hash and the torch version
+    return Path(cache_dir) / f"{Path(w).stem}-{file_hash(w)[:16]}-torch{torch.__version__.replace('+', '_')}.pt"
+
+
+def trace_cache_file(w, cache_dir, shape, device, suffix='.torchscript.pt'):
+    # Traced/exported model cache entry for weights file w, input shape (b, 3, h, w), device and torch version
+    b, _, h, w_ = shape
+    return Path(cache_dir) / (f"{Path(w).stem}-{file_hash(w)[:16]}-{b}x{h}x{w_}-{str(device).replace(':', '')}"
+                              f"-torch{torch.__version__.replace('+', '_')}{suffix}")
+
+
+def load_deploy_model(w, map_location=None, cache_dir=None):
+    # Loads the fused FP32 eval model of checkpoint w. With cache_dir, the fused model is saved there on first load
+    # and read back directly afterwards, skipping the training checkpoint and Model.fuse() (RepConv reparameterization)
+    if str(w).endswith('.flat'):  # already fused, memory-mapped instead of unpickled
+        from utils.flat_weights import load_flat
+        return load_flat(w, map_location)
+    if cache_dir:
+        f = deploy_cache_file(w, cache_dir)
+        if f.exists():
+            print(f'Loading deploy cache {f}')
+            return torch.load(f, map_location=map_location)['model']
+
+    ckpt = torch.load(w, map_location=map_location)  # load
+    model = ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval()  # FP32 model
+    if cache_dir:
+        f.parent.mkdir(parents=True, exist_ok=True)
+        meta = {'weights': str(w), 'sha256': file_hash(w), 'torch': torch.__version__,
+                'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+        tmp = f.with_suffix(f'.{os.getpid()}.tmp')
+        torch.save({'model': model, 'meta': meta}, tmp)
+        os.replace(tmp, f)  # atomic, workers starting together never read a partial file
+        print(f'Saved deploy cache {f}')
+    return model
+
+
+def attempt_load(weights, map_location=None, cache_dir=None):
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
         attempt_download(w)
-        ckpt = torch.load(w, map_location=map_location)  # load
-        model.append(ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval())  # FP32 model
+        model.append(load_deploy_model(w, map_location, cache_dir))
     
     # Compatibility updates
     for m in model.modules():
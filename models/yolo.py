@@ -1,6 +1,7 @@
 import argparse
 import logging
 import sys
+from collections import OrderedDict
 from copy import deepcopy
 
 sys.path.append('./')  # to run '$ python *.py' files in subdirectories
@@ -197,6 +198,10 @@ class IDetect(nn.Module):
 class IKeypoint(nn.Module):
     stride = None  # strides computed during build
     export = False  # onnx export
+    end2end = False  # inference returns the decoded predictions only, for End2End export
+    sparse_kpt = False  # inference: keypoint conv only at cells with objectness > kpt_thres (single-conv head)
+    kpt_thres = 0.25  # objectness threshold of sparse_kpt, use the NMS conf_thres to keep results exact
+    grid_cache_size = 16  # decode_grid() entries kept, one per (level, ny, nx, device, dtype)
 
     def __init__(self, nc=80, anchors=(), nkpt=17, ch=(), inplace=True, dw_conv_kpt=False):  # detection layer
         super(IKeypoint, self).__init__()
@@ -234,51 +239,154 @@ class IKeypoint(nn.Module):
 
     def forward(self, x):
         # x = x.copy()  # for profiling
-        z = []  # inference output
         self.training |= self.export
+        if self.is_sparse():
+            return self.sparse_decode(x, [self.im[i](self.m[i](self.ia[i](x[i]))) for i in range(self.nl)])
         for i in range(self.nl):
             if self.nkpt is None or self.nkpt==0:
                 x[i] = self.im[i](self.m[i](self.ia[i](x[i])))  # conv
             else :
                 x[i] = torch.cat((self.im[i](self.m[i](self.ia[i](x[i]))), self.m_kpt[i](x[i])), axis=1)
+        return self.decode(x)
+
+    def fuseforward(self, x):
+        # forward after fuse(): ImplicitA/ImplicitM are folded into self.m
+        self.training |= self.export
+        if self.is_sparse():
+            return self.sparse_decode(x, [self.m[i](x[i]) for i in range(self.nl)])
+        for i in range(self.nl):
+            if self.nkpt is None or self.nkpt==0:
+                x[i] = self.m[i](x[i])  # conv
+            else :
+                x[i] = torch.cat((self.m[i](x[i]), self.m_kpt[i](x[i])), axis=1)
+        return self.decode(x)
+
+    @torch.no_grad()
+    def fuse(self, check=True):
+        # Fold ImplicitA and ImplicitM into the box/class conv of every level, as IDetect.fuse() does. With check=True
+        # the fused head is compared with the original one on random feature maps.
+        w = self.m[0].weight
+        if check:
+            training = self.training
+            self.eval()
+            x = [torch.randn(1, m.weight.shape[1], 4, 4, device=w.device, dtype=w.dtype) for m in self.m]
+            y = self.forward([xi.clone() for xi in x])[0]
+
+        for m, ia, im in zip(self.m, self.ia, self.im):
+            c2, c1, _, _ = m.weight.shape
+            m.bias += torch.matmul(m.weight.reshape(c2, c1), ia.implicit.reshape(c1, 1)).squeeze(1)  # ImplicitA
+            m.bias *= im.implicit.reshape(c2)  # ImplicitM
+            m.weight *= im.implicit.transpose(0, 1)
+
+        if check:
+            y_fused = self.fuseforward(x)[0]
+            self.train(training)
+            if not torch.allclose(y, y_fused, rtol=1e-3, atol=1e-3):
+                logger.warning(f'IKeypoint.fuse: fused head differs from the original by up to '
+                               f'{(y - y_fused).abs().max().item():.3g}')
+        return self
 
+    def is_sparse(self):
+        return self.sparse_kpt and not self.training and bool(self.nkpt) and not self.dw_conv_kpt
+
+    @torch.no_grad()
+    def check_sparse(self, ny=8, nx=8):
+        # Compare sparse_decode() with the dense head on random feature maps: boxes/objectness at every cell,
+        # keypoints at the cells that pass kpt_thres. Returns whether they agree, warns if not
+        w = self.m[0].weight
+        training, sparse_kpt = self.training, self.sparse_kpt
+        self.eval()
+        x = [torch.randn(1, m.weight.shape[1], ny, nx, device=w.device, dtype=w.dtype) for m in self.m]
+        y = []
+        for sparse in False, True:
+            self.sparse_kpt = sparse
+            out = self.forward([xi.clone() for xi in x])
+            y.append(out if self.end2end else out[0])
+        self.sparse_kpt = sparse_kpt
+        self.train(training)
+
+        dense, sparse = y
+        keep = dense[..., 4] > self.kpt_thres
+        error = max((dense[..., :self.no_det] - sparse[..., :self.no_det]).abs().max().item(),
+                    (dense[keep] - sparse[keep]).abs().max().item() if keep.any() else 0.)
+        if error > 1e-3 * max(dense.abs().max().item(), 1.):
+            logger.warning(f'IKeypoint.sparse_decode: differs from the dense head by up to {error:.3g}')
+            return False
+        return True
+
+    def sparse_decode(self, x, det):
+        # Inference with the keypoint conv evaluated only where objectness passes kpt_thres. x are the input feature
+        # maps, det the box/class conv outputs per level. The dense head views cat(det, keypoint conv) as
+        # (bs, na, no, ny, nx), so anchor a owns the concatenated channels [a * no, (a + 1) * no) and, with na > 1,
+        # its box/objectness partly come from keypoint conv rows and its keypoints partly from det. Channels are
+        # therefore picked by their index in that concatenation: the box/objectness ones densely, the rest at the
+        # surviving cells only. A 1x1 conv at one cell is a matmul of that cell's features, so the gathered keypoints
+        # equal the dense ones (check_sparse()). Keypoint columns of all other cells are left at 0.
+        # Returns (decoded (bs,n,no), raw box/class maps x(bs,na,ny,nx,no_det))
+        z = []
+        nd = self.na * self.no_det  # det channels, the keypoint conv's follow them in the concatenation
+        for i in range(self.nl):
+            bs, _, ny, nx = det[i].shape
+            conv = self.m_kpt[i]
+            rows = torch.arange(self.na * self.no, device=det[i].device).view(self.na, self.no)  # concatenated channels
+            box_rows = rows[:, :self.no_det].reshape(-1)
+            in_det = box_rows < nd
+            d = det[i].new_empty(bs, nd, ny, nx)
+            d[:, in_det] = det[i][:, box_rows[in_det]]
+            k = box_rows[~in_det] - nd  # box/objectness rows of the keypoint conv
+            if len(k):
+                d[:, ~in_det] = F.conv2d(x[i], conv.weight[k], conv.bias[k])
+            raw = det[i]
+            det[i] = d.view(bs, self.na, self.no_det, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
+            xy_grid, scale, anchor_wh, _, _ = self.decode_grid(i, ny, nx, det[i])
+
+            yd = det[i].sigmoid()
+            y = torch.zeros(bs, self.na, ny, nx, self.no, device=yd.device, dtype=yd.dtype)
+            y[..., 0:2] = torch.add(xy_grid, yd[..., 0:2], alpha=scale)  # xy
+            y[..., 2:4] = yd[..., 2:4].square() * anchor_wh  # wh
+            y[..., 4:self.no_det] = yd[..., 4:]
+
+            b, a, gy, gx = (yd[..., 4] > self.kpt_thres).nonzero(as_tuple=True)  # surviving (image, anchor, y, x)
+            if len(b):
+                f = x[i][b, :, gy, gx]  # (k, c) features of surviving cells
+                kpt = torch.addmm(conv.bias, f, conv.weight.view(conv.out_channels, -1).T)  # 1x1 conv, all rows
+                cells = torch.cat((raw[b, :, gy, gx], kpt), 1)  # (k, na * no) concatenated channels per cell
+                kpt = cells.gather(1, rows[a, self.no_det:])  # own anchor's keypoint channels
+                kpt[:, 0::3] = (kpt[:, 0::3] * 2. - 0.5 + gx[:, None]) * self.stride[i]  # xy
+                kpt[:, 1::3] = (kpt[:, 1::3] * 2. - 0.5 + gy[:, None]) * self.stride[i]
+                kpt[:, 2::3] = kpt[:, 2::3].sigmoid()
+                y[b, a, gy, gx, self.no_det:] = kpt
+            z.append(y.view(bs, -1, self.no))
+        return torch.cat(z, 1) if self.end2end else (torch.cat(z, 1), det)
+
+    def decode(self, x):
+        # Reshape conv outputs x(bs,na*no,ny,nx) to x(bs,na,ny,nx,no) and, at inference, decode them to boxes/keypoints
+        z = []  # inference output
+        for i in range(self.nl):
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
             x_det = x[i][..., :6]
             x_kpt = x[i][..., 6:]
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
-                kpt_grid_x = self.grid[i][..., 0:1]
-                kpt_grid_y = self.grid[i][..., 1:2]
-
                 if self.nkpt == 0:
                     y = x[i].sigmoid()
                 else:
                     y = x_det.sigmoid()
 
                 if self.inplace:
-                    xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i].view(1, self.na, 1, 1, 2) # wh
+                    xy_grid, scale, anchor_wh, kpt_grid, kpt_scale = self.decode_grid(i, ny, nx, x[i])
+                    xy = torch.add(xy_grid, y[..., 0:2], alpha=scale)  # (y * 2 - 0.5 + grid) * stride
+                    wh = y[..., 2:4].square() * anchor_wh  # (y * 2) ** 2 * anchor
                     if self.nkpt != 0:
-                        x_kpt[..., 0::3] = (x_kpt[..., ::3] * 2. - 0.5 + kpt_grid_x.repeat(1,1,1,1,17)) * self.stride[i]  # xy
-                        x_kpt[..., 1::3] = (x_kpt[..., 1::3] * 2. - 0.5 + kpt_grid_y.repeat(1,1,1,1,17)) * self.stride[i]  # xy
-                        #x_kpt[..., 0::3] = (x_kpt[..., ::3] + kpt_grid_x.repeat(1,1,1,1,17)) * self.stride[i]  # xy
-                        #x_kpt[..., 1::3] = (x_kpt[..., 1::3] + kpt_grid_y.repeat(1,1,1,1,17)) * self.stride[i]  # xy
-                        #print('=============')
-                        #print(self.anchor_grid[i].shape)
-                        #print(self.anchor_grid[i][...,0].unsqueeze(4).shape)
-                        #print(x_kpt[..., 0::3].shape)
-                        #x_kpt[..., 0::3] = ((x_kpt[..., 0::3].tanh() * 2.) ** 3 * self.anchor_grid[i][...,0].unsqueeze(4).repeat(1,1,1,1,self.nkpt)) + kpt_grid_x.repeat(1,1,1,1,17) * self.stride[i]  # xy
-                        #x_kpt[..., 1::3] = ((x_kpt[..., 1::3].tanh() * 2.) ** 3 * self.anchor_grid[i][...,1].unsqueeze(4).repeat(1,1,1,1,self.nkpt)) + kpt_grid_y.repeat(1,1,1,1,17) * self.stride[i]  # xy
-                        #x_kpt[..., 0::3] = (((x_kpt[..., 0::3].sigmoid() * 4.) ** 2 - 8.) * self.anchor_grid[i][...,0].unsqueeze(4).repeat(1,1,1,1,self.nkpt)) + kpt_grid_x.repeat(1,1,1,1,17) * self.stride[i]  # xy
-                        #x_kpt[..., 1::3] = (((x_kpt[..., 1::3].sigmoid() * 4.) ** 2 - 8.) * self.anchor_grid[i][...,1].unsqueeze(4).repeat(1,1,1,1,self.nkpt)) + kpt_grid_y.repeat(1,1,1,1,17) * self.stride[i]  # xy
-                        x_kpt[..., 2::3] = x_kpt[..., 2::3].sigmoid()
+                        x_kpt = torch.addcmul(kpt_grid, x_kpt, kpt_scale)  # xy like boxes, conf as is
+                        x_kpt[..., 2::3].sigmoid_()
 
                     y = torch.cat((xy, wh, y[..., 4:], x_kpt), dim = -1)
 
                 else:  # for YOLOv5 on AWS Inferentia https://github.com/ultralytics/yolov5/pull/2953
+                    if self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                        self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
                     xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
                     wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
                     if self.nkpt != 0:
@@ -287,7 +395,34 @@ class IKeypoint(nn.Module):
 
                 z.append(y.view(bs, -1, self.no))
 
-        return x if self.training else (torch.cat(z, 1), x)
+        if self.training:
+            return x
+        return torch.cat(z, 1) if self.end2end else (torch.cat(z, 1), x)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_decode_grids', None)  # device tensors, rebuilt on demand
+        return state
+
+    def decode_grid(self, i, ny, nx, t):
+        # Decode constants of level i for a (ny, nx) map on t's device and dtype, kept in a small LRU cache so
+        # alternating input shapes don't rebuild them: xy grid (grid - 0.5) * stride, box xy scale 2 * stride,
+        # anchors * 4, keypoint grid/scale pre-expanded to the x, y, conf layout of the keypoint channels
+        cache = self.__dict__.setdefault('_decode_grids', OrderedDict())  # not in __init__: models load by unpickling
+        key = (i, ny, nx, t.device, t.dtype)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        s = float(self.stride[i])
+        xy_grid = (self._make_grid(nx, ny).to(t.device, t.dtype) - 0.5) * s
+        anchor_wh = (self.anchor_grid[i].view(1, self.na, 1, 1, 2) * 4).to(t.device, t.dtype)
+        kpt_grid = torch.cat((xy_grid, torch.zeros_like(xy_grid[..., :1])), -1).repeat(1, 1, 1, 1, self.nkpt or 0)
+        kpt_scale = torch.tensor([2 * s, 2 * s, 1.], device=t.device, dtype=t.dtype).repeat(self.nkpt or 0)
+        cache[key] = xy_grid, 2 * s, anchor_wh, kpt_grid, kpt_scale
+        if len(cache) > self.grid_cache_size:
+            cache.popitem(last=False)  # least recently used
+        return cache[key]
 
     @staticmethod
     def _make_grid(nx=20, ny=20):
@@ -621,6 +756,9 @@ class Model(nn.Module):
             elif isinstance(m, IDetect):
                 m.fuse()
                 m.forward = m.fuseforward
+            elif isinstance(m, IKeypoint):
+                m.fuse()
+                m.forward = m.fuseforward
         self.info()
         return self
 
@@ -1,20 +1,29 @@
 import cv2
 import time
+import queue
 import torch
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
-from torchvision import transforms
-from utils.datasets import letterbox
-from utils.torch_utils import select_device
-from models.experimental import attempt_load
-from utils.general import non_max_suppression_kpt,strip_optimizer,xyxy2xywh
-from utils.plots import output_to_keypoint, plot_skeleton_kpts,colors,plot_one_box_kpt
+from utils.datasets import Letterboxer, FrameTensor
+from utils.torch_utils import select_device, CachedTracedModel, PrecisionModel, precision_table
+from models.experimental import attempt_load, deploy_cache_file, trace_cache_file
+from models.backends import BACKENDS, load_backend
+from utils.general import non_max_suppression_kpt_batched,strip_optimizer,xyxy2xywh,check_img_size,clip_coords,make_divisible,set_logging
+from utils.plots import plot_skeletons,colors,plot_one_box_kpt
+from utils.pipeline import Frame, Stage, STOP, run_stages, KeypointWriter, LatencyController
+from utils.quantization import QuantizedModel, calibration_frames, quantization_report
+from utils.tracking import KeypointPropagator, MotionGate, RoiDetector
 import subprocess
 
 @torch.no_grad()
 def run(poseweights="yolov7-w6-pose.pt",source="football1.mp4",device='cpu',view_img=False,
-        save_conf=False,line_thickness = 3,hide_labels=False, hide_conf=True, rtmp_url=None):
+        save_conf=False,line_thickness = 3,hide_labels=False, hide_conf=True, rtmp_url=None,
+        queue_size=4, batch_size=1, background='background.png', max_candidates=30000, max_det=300,
+        export=None, max_persons=20, sparse_kpt=False, deploy_cache='deploy_cache', trace=False,
+        backend='torch', int8=False, calib_source=None, calib_frames=32, precision='fp32', channels_last=False,
+        img_size=None, native_render=False, latency_budget=None, keyframe_interval=0,
+        motion_thres=0, roi_interval=0, roi_size=320, roi_margin=0.3):
 
     frame_count = 0  #count no of frames
     total_fps = 0  #count total fps
@@ -22,10 +31,14 @@ def run(poseweights="yolov7-w6-pose.pt",source="football1.mp4",device='cpu',view
     fps_list = []    #list to store fps
     
     device = select_device(opt.device) #select device
-    half = device.type != 'cpu'
 
-    model = attempt_load(poseweights, map_location=device)  #Load model
+    model = attempt_load(poseweights, map_location=device, cache_dir=deploy_cache)  #Load model
     _ = model.eval()
+    conf_thres = 0.25  #NMS confidence threshold
+    if sparse_kpt:  #keypoint conv only at cells that can pass NMS
+        model.model[-1].sparse_kpt = True
+        model.model[-1].kpt_thres = conf_thres
+        model.model[-1].check_sparse()  #warns if the sparse head disagrees with the dense one
     names = model.module.names if hasattr(model, 'module') else model.names  # get class names
    
     if source.isnumeric() :    
@@ -59,109 +72,278 @@ def run(poseweights="yolov7-w6-pose.pt",source="football1.mp4",device='cpu',view
             stdin=subprocess.PIPE  # 输入管道
         )
 
-        vid_write_image = letterbox(cap.read()[1], (frame_width), stride=64, auto=True)[0] #init videowriter
-        resize_height, resize_width = vid_write_image.shape[:2]
+        ret, first_frame = cap.read()  #first frame sizes the videowriter and is then processed like the rest
+        if not ret:
+            print('Error while trying to read video. Please check path again')
+            raise SystemExit()
+        gs = int(model.stride.max())  #grid size (max stride), 64 for the W6 model
+        img_size = check_img_size(img_size or frame_width, s=gs)  #inference width, the full frame width by default
+        letterboxer = Letterboxer(first_frame.shape, img_size, stride=gs, auto=True)  #fixed geometry for this source
+        resize_height, resize_width = letterboxer.out_shape #model input size
+        #poses are mapped back to source frame coordinates, the canvas is the frame itself or the letterboxed input
+        canvas_height, canvas_width = first_frame.shape[:2] if native_render else letterboxer.out_shape
+
+        controller = None
+        if latency_budget:  #live sources: trade inference size, then frames, for latency
+            assert backend == 'torch' and not trace, '--latency-budget needs the eager torch backend (input size changes)'
+            set_logging()  #controller steps are logged
+            ladder = [max(make_divisible(img_size * r, gs), 2 * gs) for r in (1, 0.85, 0.7, 0.55, 0.4)]
+            controller = LatencyController(ladder, latency_budget / 1000)
+            batch_size = 1  #frames go out as soon as they are ready
+
+        propagator = None
+        if keyframe_interval > 1:  #network on keyframes only, keypoints carried forward by optical flow in between
+            propagator = KeypointPropagator(keyframe_interval, nkpt=model.yaml['nkpt'])
+            batch_size = 1  #each frame's decision depends on the previous one
+
+        roi = None
+        if roi_interval > 1:  #crops around the previous frame's people, full frame every roi_interval frames
+            assert backend == 'torch' and not trace, '--roi-interval needs the eager torch backend (crop batch shapes vary)'
+            assert propagator is None, '--roi-interval and --keyframe-interval are alternatives'
+            roi = RoiDetector(device, check_img_size(roi_size, s=gs), roi_margin, roi_interval)
+            batch_size = 1  #crops come from the previous frame's detections
+
+        shape = (batch_size, 3, resize_height, resize_width)  #model input, after the modes that force batches of one
+        if int8:  #INT8 backbone calibrated on frames of the source, IKeypoint decode and NMS stay float
+            assert device.type == 'cpu' and backend == 'torch', '--int8 is a CPU mode of the torch backend'
+            frames = calibration_frames(calib_source or source, img_size, gs, calib_frames)
+            int8_model = QuantizedModel(model, frames[::2])
+            quantization_report(model, int8_model, frames[1::2] or frames, conf_thres)  #frames not used to calibrate
+            model = int8_model
+        elif (precision == 'bf16' or channels_last) and backend == 'torch':  #backbone in bf16/channels_last, head fp32
+            model = PrecisionModel(model, channels_last, precision == 'bf16')
+        elif trace and backend == 'torch':  #traced backbone for this input shape, the eager model serves until it is ready
+            weights = poseweights[0] if isinstance(poseweights, list) else poseweights
+            model = CachedTracedModel(model, shape, trace_cache_file(weights, deploy_cache or '.', shape, device))
+        engine = load_backend(backend, model, poseweights, shape, deploy_cache or '.',  #runs the forward pass
+                              conf_thres, 0.65, max_det)
         out_video_name = f"{source.split('/')[-1].split('.')[0]}"
         out = cv2.VideoWriter(f"{source}_keypoint.mp4",
                             cv2.VideoWriter_fourcc(*'mp4v'), 30,
-                            (resize_width, resize_height))
+                            (canvas_width, canvas_height))
 
         # TODO：替换成OSS获取的图片
-        background_path = "background.png"
-        background = cv2.imread(background_path)  # Read the background image
-
-        if background is None:
-            print(f"Error: Unable to load background image from {background_path}")
-            return
-        background = cv2.cvtColor(background, cv2.COLOR_BGR2RGB)  # 转换为 RGB 作为背景
-        background = letterbox(background, (frame_width), stride=64, auto=True)[0]
-        background = background.copy()
-        background = transforms.ToTensor()(background)
-        background = torch.tensor(np.array([background.numpy()]))
-        background = background.to(device)  #convert image data to device
-        background = background.float() #convert image to float precision (cpu)
-
-        while(cap.isOpened): #loop until cap opened or video not complete
-        
-            print("Frame {} Processing".format(frame_count+1))
-
-            ret, frame = cap.read()  #get frame and success from video capture
-            
-            if ret: #if success is true, means frame exist
-                orig_image = frame #store frame
-                image = cv2.cvtColor(orig_image, cv2.COLOR_BGR2RGB) #convert frame to RGB
-                image = letterbox(image, (frame_width), stride=64, auto=True)[0]
-                image_ = image.copy()
-                image = transforms.ToTensor()(image)
-                image = torch.tensor(np.array([image.numpy()]))
-            
-                image = image.to(device)  #convert image data to device
-                image = image.float() #convert image to float precision (cpu)
-                start_time = time.time() #start time for fps calculation
-            
-                with torch.no_grad():  #get predictions
-                    output_data, _ = model(image)
-
-                output_data = non_max_suppression_kpt(output_data,   #Apply non max suppression
-                                            0.25,   # Conf. Threshold.
+        if background:
+            background_image = cv2.imread(background)  # Read the background image
+            if background_image is None:
+                print(f"Error: Unable to load background image from {background}")
+                return
+            # prepared once: the background letterboxed to the output canvas size as BGR uint8
+            background_image = Letterboxer(background_image.shape, (canvas_height, canvas_width), auto=False)(background_image)
+        writer = None
+        if export:  # structured keypoint export, written from a background thread
+            n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if not source.isnumeric() else 0
+            writer = KeypointWriter(export, n_frames, max_persons, model.yaml['nkpt'])
+
+        n_canvas = queue_size + 3  #canvases alive between render and the slower sink
+        if native_render:
+            canvases = [np.empty((canvas_height, canvas_width, 3), dtype=np.uint8) for _ in range(n_canvas)]
+        else:
+            canvases = [letterboxer.new_buffer() for _ in range(n_canvas)]  #reused render buffers
+
+        # Each step below runs in its own worker thread, joined by bounded queues (see utils/pipeline.py):
+        # capture -> preprocess -> inference -> render -> (ffmpeg stream, video file)
+        def read_frames():
+            index = 0
+            ret, frame = True, first_frame
+            while ret and cap.isOpened(): #loop until cap opened or video not complete
+                yield Frame(index, frame)
+                index += 1
+                ret, frame = cap.read()  #get frame and success from video capture
+
+        frames = read_frames()
+
+        def capture():
+            f = next(frames, STOP)
+            if f is STOP:
+                return f
+            if controller is not None and not controller.keep(f.index):
+                return None  #dropped to hold the latency budget
+            f.reuse = gate is not None and gate.static(f.image)  #near-static frame, the last detections are reused
+            return f
+
+        n_slots = queue_size + batch_size + 2  #frames alive between preprocess and the end of their forward pass
+        geometries = {}  #letterboxer and input slots per inference size
+
+        def geometry(size, lb=None):
+            if size not in geometries:
+                lb = lb or Letterboxer(first_frame.shape, size, stride=gs, auto=True)
+                tt = FrameTensor(lb.out_shape, device, n_slots)
+                for frame_slot in tt.frames:
+                    lb.new_buffer(out=frame_slot)  #padding is written once per slot
+                geometries[size] = lb, tt
+            return geometries[size]
+
+        _, to_tensor = geometry(img_size, letterboxer)
+
+        gate = MotionGate(motion_thres) if motion_thres > 0 else None  #static camera stretches skip the network
+        last_output = None  #detections of the last processed frame
+        gate_time, gate_frames = 0., 0  #inference time and frames processed, for the compute the gate saved
+
+        # bytes copied per frame by the old cvtColor -> ToTensor -> np.array -> torch.tensor (-> .to(device)) chain
+        legacy_bytes = (54 + 12 * (device.type != 'cpu')) * resize_height * resize_width
+        print(f"Preprocess copies per frame: {legacy_bytes / 1E6:.1f}MB before, {to_tensor.bytes_per_frame / 1E6:.1f}MB now")
+
+        slot_count = canvas_count = 0  #frames through preprocess / render: ring positions, dropped frames leave no gaps
+
+        def preprocess(f):
+            nonlocal slot_count
+            if f.reuse:  #no model input needed
+                return f
+            slot = slot_count % n_slots
+            slot_count += 1
+            f.letterboxer, frame_tensor = geometry(controller.size) if controller is not None else (letterboxer, to_tensor)
+            f.letterboxer(f.image, out=frame_tensor.frames[slot])  #letterbox straight into the tensor's host buffer
+            f.input = frame_tensor(slot)  #BGR->RGB, /255, HWC->NCHW in one pass
+            return f
+
+        def detect(image):
+            with torch.no_grad():  #get predictions
+                output_data = engine(image)
+
+                if not engine.nms:  #in-graph NMS backends return the detections directly
+                    output_data = non_max_suppression_kpt_batched(output_data,   #Apply non max suppression
+                                            conf_thres,   # Conf. Threshold.
                                             0.65, # IoU Threshold.
                                             nc=model.yaml['nc'], # Number of classes.
                                             nkpt=model.yaml['nkpt'], # Number of keypoints.
-                                            kpt_label=True)
-            
-                output = output_to_keypoint(output_data)
-
-                # im0 = image[0].permute(1, 2, 0) * 255 # 使用原始帧； Change format [b, c, h, w] to [h, w, c] for displaying the image.
-                im0 = background[0].permute(1, 2, 0) * 255 # 使用背景图片；Change format [b, c, h, w] to [h, w, c] for displaying the image.
-                im0 = im0.cpu().numpy().astype(np.uint8)
-                
-                im0 = cv2.cvtColor(im0, cv2.COLOR_RGB2BGR) #reshape image format to (BGR)
-                gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-
-                for i, pose in enumerate(output_data):  # detections per image
-                
-                    if len(output_data):  #check if no pose
-                        for c in pose[:, 5].unique(): # Print results
-                            n = (pose[:, 5] == c).sum()  # detections per class
-                            print("No of Objects in Current Frame : {}".format(n))
-                        
-                        for det_index, (*xyxy, conf, cls) in enumerate(reversed(pose[:,:6])): #loop over poses for drawing on frame
-                            c = int(cls)  # integer class
-                            kpts = pose[det_index, 6:]
-                            label = None if opt.hide_labels else (names[c] if opt.hide_conf else f'{names[c]} {conf:.2f}')
-                            plot_one_box_kpt(xyxy, im0, label=label, color=colors(c, True), 
-                                        line_thickness=opt.line_thickness,kpt_label=True, kpts=kpts, steps=3, 
-                                        orig_shape=im0.shape[:2])
-
-                
-                end_time = time.time()  #Calculatio for FPS
-                fps = 1 / (end_time - start_time)
-                total_fps += fps
-                frame_count += 1
-                
-                fps_list.append(total_fps) #append FPS in list
-                time_list.append(end_time - start_time) #append time in list
-                
-                ffimg = cv2.resize(im0, (frame_width, frame_height))  # 调整尺寸
-                ffmpeg_process.stdin.write(ffimg.tobytes())
-
-                # Stream results
-                if view_img:
-                    cv2.imshow("YOLOv7 Pose Estimation Demo", im0)
-                    cv2.waitKey(1)  # 1 millisecond
-
-                out.write(im0)  #writing the video frame
+                                            max_candidates=max_candidates, # Boxes kept by objectness before NMS.
+                                            max_det=max_det) # Detections per image.
+            return output_data  #per image, in input coordinates
+
+        def infer(batch):
+            nonlocal frame_count, total_fps, last_output, gate_time, gate_frames
+            start_time = time.time() #start time for fps calculation
+
+            live = [f for f in batch if not f.reuse]  #frames that need detections of their own
+            keyframe = propagator is None or bool(live) and propagator.need_detection(live[0].image)  #batches of one with a propagator
+            full = not live or roi is None or roi.need_full(last_output[0] if last_output else None)
+            if not live:
+                output_data = []
+            elif not keyframe:  #previous keypoints moved by optical flow, already in source frame coordinates
+                output_data = [propagator.propagate(live[0].image, device)]
+            elif not full:  #crops around the previous frame's people in one batch, merged in source frame coordinates
+                crops, regions = roi.batch(live[0].image, last_output[0][:, :4])
+                output_data = [roi.merge(detect(crops), regions, 0.65)]
+            else:
+                image = torch.cat([f.input for f in live]) if len(live) > 1 else live[0].input  #stack frames into one batch
+                output_data = detect(image)
+
+            for f, pose in zip(live, output_data):  #split per-image detections back into frame order
+                if keyframe:
+                    if full:
+                        f.letterboxer.inverse(pose[:, :4])  #boxes and keypoints to source frame coordinates
+                        f.letterboxer.inverse(pose[:, 6:], steps=3)
+                    clip_coords(pose, letterboxer.shape)
+                    if propagator is not None:
+                        propagator.update(f.image, pose)
+                f.output = [pose]
+            for f in batch:  #gated frames take the detections of the processed frame before them
+                if f.reuse:
+                    f.output = last_output
+                else:
+                    last_output = f.output
+                if writer is not None:
+                    writer.write(f.index, f.output[0])  #queued only, the writer thread does the host copy and I/O
+
+            end_time = time.time()  #Calculatio for FPS
+            n = len(live)  #gated frames ran nothing, the motion gate summary reports them
+            if n:
+                fps = n / (end_time - start_time)
+                total_fps += fps * n
+                frame_count += n
+                gate_time += end_time - start_time
+                gate_frames += n
+
+                fps_list.extend([total_fps] * n) #append FPS in list
+                time_list.extend([(end_time - start_time) / n] * n) #append time in list
+            if controller is not None and live and keyframe:  #only forward passes measure the network's latency
+                controller.update((end_time - start_time) / len(live))
+            return batch
 
+        def render(f):
+            nonlocal canvas_count
+            print("Frame {} Processing".format(f.index+1))
+
+            im0 = canvases[canvas_count % n_canvas]
+            canvas_count += 1
+            if background:
+                np.copyto(im0, background_image)  # 使用背景图片
+            elif native_render:
+                im0 = f.image  # 使用原始帧, drawn on directly
             else:
-                break
+                letterboxer(f.image, out=im0)  # 使用原始帧
+
+            for i, pose in enumerate(f.output):  # detections per image
+                if not native_render:  #source frame coordinates to the letterboxed canvas
+                    pose = pose.clone()
+                    letterboxer.transform(pose[:, :4])
+                    letterboxer.transform(pose[:, 6:], steps=3)
+
+                if len(f.output):  #check if no pose
+                    for c in pose[:, 5].unique(): # Print results
+                        n = (pose[:, 5] == c).sum()  # detections per class
+                        print("No of Objects in Current Frame : {}".format(n))
+
+                    for *xyxy, conf, cls in reversed(pose[:,:6]): #loop over poses for drawing boxes on frame
+                        c = int(cls)  # integer class
+                        label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
+                        plot_one_box_kpt(xyxy, im0, label=label, color=colors(c, True),
+                                    line_thickness=line_thickness,kpt_label=False)
+                    plot_skeletons(im0, pose[:, 6:], steps=3)  #all skeletons in one batched call
+            f.canvas = im0
+            return f
+
+        def stream(f):
+            ffimg = f.canvas if native_render else cv2.resize(f.canvas, (frame_width, frame_height))  # 调整尺寸
+            ffmpeg_process.stdin.write(ffimg.tobytes())
+
+        def save(f):
+            # Stream results
+            if view_img:
+                cv2.imshow("YOLOv7 Pose Estimation Demo", f.canvas)
+                cv2.waitKey(1)  # 1 millisecond
+
+            out.write(f.canvas)  #writing the video frame
+
+        captured, prepared, inferred, to_stream, to_file = (queue.Queue(maxsize=queue_size) for _ in range(5))
+        stages = [Stage('capture', capture, sinks=[captured]),
+                  Stage('preprocess', preprocess, captured, [prepared]),
+                  Stage('inference', infer, prepared, [inferred], batch_size=batch_size),
+                  Stage('render', render, inferred, [to_stream, to_file]),
+                  Stage('stream', stream, to_stream),
+                  Stage('save', save, to_file)]
 
-        # 结束流时清理资源
-        ffmpeg_process.stdin.close()
-        ffmpeg_process.wait()
-        cap.release()
-        # cv2.destroyAllWindows()
+        t0 = time.time()
+        try:
+            run_stages(stages)
+        finally:
+            # 结束流时清理资源
+            ffmpeg_process.stdin.close()
+            ffmpeg_process.wait()
+            cap.release()
+            out.release()
+            if writer is not None:
+                writer.close()
+            # cv2.destroyAllWindows()
+        wall_time = time.time() - t0
         avg_fps = total_fps / frame_count
         print(f"Average FPS: {avg_fps:.3f}")
+        frames_out = frame_count + (gate.hits if gate is not None else 0)  #processed and gated frames
+        print(f"Pipeline throughput: {frames_out / wall_time:.3f} FPS ({frames_out} frames in {wall_time:.1f}s)")
+        if controller is not None:
+            print(f"Latency controller: {controller.steps} adjustments, ended at {controller.describe()}")
+        if propagator is not None:
+            print(f"Keyframe inference: {propagator.describe()}")
+        if roi is not None:
+            print(f"ROI re-detection: {roi.describe(resize_height * resize_width)}")
+        if gate is not None:
+            saved = gate.hits * gate_time / max(gate_frames, 1)  #at the mean inference time of a processed frame
+            print(f"Motion gate: {gate.describe()}, ~{saved:.1f}s of inference saved "
+                  f"({saved / (saved + gate_time + gate.time):.1%} of inference compute)")
+        if isinstance(model, PrecisionModel):  #how the chosen mode compares with the others on this input
+            print(f"Forward throughput per mode (running {model.mode}):")
+            precision_table(model.model, shape)
         
         #plot the comparision graph
         plot_fps_time_comparision(time_list=time_list,fps_list=fps_list)
@@ -169,7 +351,7 @@ def run(poseweights="yolov7-w6-pose.pt",source="football1.mp4",device='cpu',view
 
 def parse_opt():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--poseweights', nargs='+', type=str, default='yolov7-w6-pose.pt', help='model path(s)')
+    parser.add_argument('--poseweights', nargs='+', type=str, default='yolov7-w6-pose.pt', help='model path(s), .pt or .flat (utils/flat_weights.py)')
     parser.add_argument('--source', type=str, default='football1.mp4', help='video/0 for webcam') #video source
     parser.add_argument('--device', type=str, default='cpu', help='cpu/0,1,2,3(gpu)')   #device arugments
     parser.add_argument('--view-img', action='store_true', help='display results')  #display results
@@ -178,6 +360,30 @@ def parse_opt():
     parser.add_argument('--hide-labels', default=False, action='store_true', help='hide labels') #box hidelabel
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences') #boxhideconf
     parser.add_argument('--rtmp-url', type=str, default=None, help='RTMP URL for live streaming')
+    parser.add_argument('--background', type=str, default='background.png', help="image to draw poses on, '' for the video frame")
+    parser.add_argument('--max-candidates', default=30000, type=int, help='boxes per image kept by objectness before NMS')
+    parser.add_argument('--max-det', default=300, type=int, help='maximum detections per image')
+    parser.add_argument('--export', type=str, default=None, help='write keypoints to a .jsonl file or a .npy memmap')
+    parser.add_argument('--max-persons', default=20, type=int, help='persons per frame kept in a .npy export')
+    parser.add_argument('--sparse-kpt', action='store_true', help='decode keypoints only where objectness passes NMS')
+    parser.add_argument('--deploy-cache', type=str, default='deploy_cache', help="dir of fused models for fast startup, '' to disable")
+    parser.add_argument('--trace', action='store_true', help='run a TorchScript-traced model, cached in --deploy-cache')
+    parser.add_argument('--backend', type=str, default='torch', choices=BACKENDS, help='inference engine')
+    parser.add_argument('--int8', action='store_true', help='INT8 quantized backbone (CPU), prints drift/throughput vs fp32')
+    parser.add_argument('--calib-source', type=str, default=None, help='images/video to calibrate --int8 on, default --source')
+    parser.add_argument('--calib-frames', default=32, type=int, help='frames drawn for --int8 calibration and report')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='backbone precision, bf16 via autocast')
+    parser.add_argument('--channels-last', action='store_true', help='run the backbone in channels_last memory format')
+    parser.add_argument('--img-size', type=int, default=None, help='inference size (pixels), default the frame width')
+    parser.add_argument('--native-render', action='store_true', help='draw on the source resolution frame')
+    parser.add_argument('--latency-budget', type=float, default=None, help='per-frame inference budget (ms) for live sources')
+    parser.add_argument('--keyframe-interval', default=0, type=int, help='run the network every N frames, optical flow in between')
+    parser.add_argument('--motion-thres', default=0, type=float, help='reuse detections of frames this similar (0-1 mean abs diff), 0 off')
+    parser.add_argument('--roi-interval', default=0, type=int, help='detect in crops around known people, full frame every N frames')
+    parser.add_argument('--roi-size', default=320, type=int, help='--roi-interval crop input size (pixels)')
+    parser.add_argument('--roi-margin', default=0.3, type=float, help='--roi-interval crop margin, fraction of the box size')
+    parser.add_argument('--batch-size', default=1, type=int, help='frames stacked into one forward pass (offline video)')
+    parser.add_argument('--queue-size', default=4, type=int, help='max frames buffered between pipeline stages')
 
     opt = parser.parse_args()
     return opt
@@ -198,5 +404,8 @@ def main(opt):
 
 if __name__ == "__main__":
     opt = parse_opt()
-    strip_optimizer(opt.device,opt.poseweights)
+    for w in opt.poseweights if isinstance(opt.poseweights, list) else [opt.poseweights]:
+        cached = opt.deploy_cache and deploy_cache_file(w, opt.deploy_cache).exists()
+        if not (cached or w.endswith('.flat')):  #cached weights and flat files are stripped already
+            strip_optimizer(opt.device, w)
     main(opt)
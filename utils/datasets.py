@@ -984,6 +984,16 @@ def replicate(img, labels):
 def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
     # Resize and pad image while meeting stride-multiple constraints
     shape = img.shape[:2]  # current shape [height, width]
+    ratio, new_unpad, (dw, dh), (top, bottom, left, right) = letterbox_geometry(shape, new_shape, auto, scaleFill,
+                                                                                scaleup, stride)
+    if shape[::-1] != new_unpad:  # resize
+        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
+    return img, ratio, (dw, dh)
+
+
+def letterbox_geometry(shape, new_shape=(640, 640), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Scale ratio, resized (w, h), padding and (top, bottom, left, right) border used by letterbox()
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
 
@@ -1006,12 +1016,86 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     dw /= 2  # divide padding into 2 sides
     dh /= 2
 
-    if shape[::-1] != new_unpad:  # resize
-        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
-    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
-    return img, ratio, (dw, dh)
+    return ratio, new_unpad, (dw, dh), (top, bottom, left, right)
+
+
+class Letterboxer:
+    # letterbox() for fixed-size streams: the geometry is computed once for the source shape and every frame is
+    # resized straight into a preallocated padded buffer whose border is filled only once
+    def __init__(self, shape, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True,
+                 stride=32):
+        self.shape = tuple(shape[:2])  # source [height, width]
+        self.color = color
+        self.ratio, self.new_unpad, self.pad, (top, bottom, left, right) = letterbox_geometry(
+            self.shape, new_shape, auto, scaleFill, scaleup, stride)
+        self.offset = left, top  # where the resized image starts in the padded output
+        self.out_shape = self.new_unpad[1] + top + bottom, self.new_unpad[0] + left + right  # padded [height, width]
+        self.buffer = self.new_buffer()
+
+    def new_buffer(self, out=None):
+        # Padded output image filled with the border color, 'out' may be an existing (h, w, 3) uint8 array to use
+        if out is None:
+            return np.full((*self.out_shape, 3), self.color, dtype=np.uint8)
+        out[:] = self.color
+        return out
+
+    def __call__(self, img, out=None):
+        # Letterbox img into 'out' (default the internal buffer) without allocating, returns 'out'
+        assert img.shape[:2] == self.shape, f'Letterboxer built for {self.shape} frames, got {img.shape[:2]}'
+        out = self.buffer if out is None else out
+        (left, top), (w, h) = self.offset, self.new_unpad
+        roi = out[top:top + h, left:left + w]  # view, written in place
+        if self.shape[::-1] != self.new_unpad:  # resize
+            cv2.resize(img, self.new_unpad, dst=roi, interpolation=cv2.INTER_LINEAR)
+        else:
+            np.copyto(roi, img)
+        return out
+
+    def transform(self, coords, steps=2):
+        # Map source frame coords to letterboxed coords in place, the reverse of inverse()
+        coords[:, 0::steps] *= self.ratio[0]
+        coords[:, 1::steps] *= self.ratio[1]
+        coords[:, 0::steps] += self.offset[0]  # x padding
+        coords[:, 1::steps] += self.offset[1]  # y padding
+        return coords
+
+    def inverse(self, coords, steps=2):
+        # Map letterboxed coords back to the source frame in place. Columns come in groups of 'steps' starting with
+        # x, y, i.e. steps=2 for xyxy boxes and steps=3 for (x, y, conf) keypoints
+        coords[:, 0::steps] -= self.offset[0]  # x padding
+        coords[:, 1::steps] -= self.offset[1]  # y padding
+        coords[:, 0::steps] /= self.ratio[0]
+        coords[:, 1::steps] /= self.ratio[1]
+        return coords
+
+
+class FrameTensor:
+    # Letterboxed uint8 HWC BGR frames to normalized float NCHW RGB model input without intermediate copies.
+    # Frames are written into a ring of host uint8 slots (pinned for CUDA, exposed as numpy views in self.frames) and
+    # each slot is converted in one pass: per channel, the BGR->RGB swap, HWC->CHW, uint8->float and /255 happen in a
+    # single torch.mul() into a preallocated float tensor. 'n' slots must cover every frame alive between the writer
+    # of a slot and the consumer of its tensor.
+    def __init__(self, shape, device, n=1):
+        h, w = shape
+        self.device = device
+        cuda = device.type == 'cuda'
+        self.host = torch.empty((n, h, w, 3), dtype=torch.uint8, pin_memory=cuda)
+        self.frames = self.host.numpy()  # numpy views, share memory with self.host
+        self.upload = torch.empty((n, h, w, 3), dtype=torch.uint8, device=device) if cuda else self.host
+        self.out = torch.empty((n, 3, h, w), dtype=torch.float32, device=device)
+        self.bytes_per_frame = (12 + 3 * cuda) * h * w  # float output (+ uint8 host to device upload)
+
+    def __call__(self, i):
+        # Returns slot i as a (1, 3, h, w) float tensor, a view into self.out
+        src = self.upload[i]
+        if self.upload is not self.host:
+            src.copy_(self.host[i], non_blocking=True)  # uint8 upload, a quarter of the float bytes
+        out = self.out[i]
+        for c in range(3):
+            torch.mul(src[..., 2 - c], 1 / 255., out=out[c])  # BGR to RGB, to float 0.0 - 1.0
+        return out[None]
 
 
 def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
@@ -0,0 +1,162 @@
+# Flat, memory-mapped weight format
+#
+# File layout: MAGIC, uint64 header length, JSON header, then one raw buffer per tensor at ALIGN-byte aligned offsets.
+# The header holds the model yaml, class names and {name: dtype, shape, offset} of every tensor of the fused model.
+# load_flat() rebuilds the module tree from the yaml through parse_model (Model(yaml)), fuses it the same way and then
+# points every parameter/buffer at the memory-mapped file. Nothing is copied on CPU, so worker processes loading the
+# same file share its physical pages through the page cache.
+#
+# Usage:
+#   $ python utils/flat_weights.py --weights yolov7-w6-pose.pt                  # convert to yolov7-w6-pose.flat
+#   $ python utils/flat_weights.py --weights yolov7-w6-pose.pt --compare 8      # startup and memory of 8 workers
+
+import argparse
+import json
+import struct
+import subprocess
+import sys
+import time
+from functools import reduce
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+sys.path.append('./')  # to run '$ python *.py' files in subdirectories
+
+MAGIC = b'YOLOFLAT'
+VERSION = 1
+ALIGN = 64  # bytes, buffer alignment
+
+
+def save_flat(model, f):
+    # Write a fused eval-mode Model to flat file f
+    tensors, offset = {}, 0
+    state = {k: v.detach().cpu().contiguous() for k, v in model.state_dict().items()}
+    for k, v in state.items():
+        offset = -(-offset // ALIGN) * ALIGN
+        tensors[k] = {'dtype': v.numpy().dtype.str, 'shape': list(v.shape), 'offset': offset}
+        offset += v.numel() * v.element_size()
+    header = json.dumps({'version': VERSION, 'yaml': model.yaml, 'names': list(model.names),
+                         'tensors': tensors}).encode()
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN  # data section offset
+
+    with open(f, 'wb') as fh:
+        fh.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for k, v in state.items():
+            fh.seek(start + tensors[k]['offset'])
+            fh.write(v.numpy().tobytes())
+        fh.truncate(start + offset)
+    return f
+
+
+def read_header(f):
+    # Returns (header dict, data section offset) of flat file f
+    with open(f, 'rb') as fh:
+        assert fh.read(len(MAGIC)) == MAGIC, f'{f} is not a flat weights file'
+        n, = struct.unpack('<Q', fh.read(8))
+        header = json.loads(fh.read(n))
+    assert header['version'] == VERSION, f"{f}: unsupported flat weights version {header['version']}"
+    return header, -(-(len(MAGIC) + 8 + n) // ALIGN) * ALIGN
+
+
+def load_flat(f, map_location=None):
+    # Load flat file f as a fused FP32 eval-mode Model whose tensors are views of a copy-on-write memmap of f
+    from models.yolo import Model  # models import utils, not the other way round at module level
+
+    header, start = read_header(f)
+    data = np.memmap(f, dtype=np.uint8, mode='c')  # private pages stay shared until written to
+    model = Model(header['yaml']).fuse().eval()  # same module tree as the one saved
+    model.names = header['names']
+
+    tensors = header['tensors']
+    state = model.state_dict()
+    assert set(state) == set(tensors), f'{f} does not match the module tree built from its yaml'
+    for k, t in tensors.items():
+        dtype = np.dtype(t['dtype'])
+        n = int(np.prod(t['shape'])) * dtype.itemsize
+        a = data[start + t['offset']:start + t['offset'] + n].view(dtype).reshape(t['shape'])
+        path, _, name = k.rpartition('.')
+        m = reduce(getattr, path.split('.'), model) if path else model
+        if name in m._parameters:
+            m._parameters[name] = nn.Parameter(torch.from_numpy(a), requires_grad=False)
+        else:
+            m._buffers[name] = torch.from_numpy(a)
+
+    if map_location is not None and torch.device(map_location).type != 'cpu':
+        model.to(map_location)  # device copies, only host loads share pages
+    return model
+
+
+def convert(weights, out=None):
+    # Convert a .pt checkpoint to a flat file next to it, returns the flat file path
+    from models.experimental import load_deploy_model
+
+    out = out or str(Path(weights).with_suffix('.flat'))
+    save_flat(load_deploy_model(weights, map_location='cpu'), out)
+    print(f'Converted {weights} to {out} ({Path(out).stat().st_size / 1E6:.1f}MB)')
+    return out
+
+
+def memory():
+    # Resident and proportional (shared pages split across processes) set size of this process in MB, Linux only
+    mem = {}
+    for file, keys in ('/proc/self/status', ('VmRSS', 'RssAnon', 'RssFile')), ('/proc/self/smaps_rollup', ('Pss',)):
+        try:
+            with open(file) as fh:
+                for line in fh:
+                    k, _, v = line.partition(':')
+                    if k in keys:
+                        mem[k] = int(v.split()[0]) / 1E3  # kB to MB
+        except OSError:
+            pass
+    return mem
+
+
+def probe(weights):
+    # Worker side of compare(): load, report ready, wait until every worker has loaded, then report memory
+    t = time.time()
+    from models.experimental import attempt_load
+    model = attempt_load(weights, map_location='cpu')
+    dt = time.time() - t
+    print('ready', flush=True)
+    sys.stdin.readline()
+    print(json.dumps({'load': dt, **memory()}), flush=True)
+    del model
+
+
+def compare(weights, flat, workers=8):
+    # Start 'workers' processes per format, all holding their model at the same time, and print startup and memory
+    print(f"{'format':>8}{'workers':>9}{'load s':>9}{'RSS MB':>9}{'anon MB':>9}{'file MB':>9}{'PSS MB':>9}")
+    for name, f in ('pt', weights), ('flat', flat):
+        procs = [subprocess.Popen([sys.executable, __file__, '--probe', f], stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) for _ in range(workers)]
+        for p in procs:  # wait until all are loaded
+            while p.stdout.readline().strip() != 'ready':
+                assert p.poll() is None, f'worker loading {f} failed'
+        results = []
+        for p in procs:
+            p.stdin.write('\n')
+            p.stdin.flush()
+            results.append(json.loads(p.stdout.readline()))
+            p.wait()
+        mean = lambda k: sum(r.get(k, float('nan')) for r in results) / len(results)
+        print(f"{name:>8}{workers:>9}{mean('load'):>9.2f}{mean('VmRSS'):>9.0f}{mean('RssAnon'):>9.0f}"
+              f"{mean('RssFile'):>9.0f}{mean('Pss'):>9.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='yolov7-w6-pose.pt', help='checkpoint to convert')
+    parser.add_argument('--out', type=str, default='', help='flat file, default: weights with .flat suffix')
+    parser.add_argument('--compare', type=int, default=0, help='compare .pt and .flat loading with N workers')
+    parser.add_argument('--probe', type=str, default='', help=argparse.SUPPRESS)  # internal, compare() worker
+    opt = parser.parse_args()
+
+    if opt.probe:
+        probe(opt.probe)
+    else:
+        flat = convert(opt.weights, opt.out)
+        if opt.compare:
+            compare(opt.weights, flat, opt.compare)
@@ -1,6 +1,8 @@
 # YOLOR general utils
 
+import functools
 import glob
+import hashlib
 import logging
 import math
 import os
@@ -696,7 +698,7 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
 
 
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=(), kpt_label=False, nc=None, nkpt=None):
+                        labels=(), kpt_label=False, nc=None, nkpt=None, max_candidates=30000, max_det=300):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
     Returns:
@@ -704,12 +706,10 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
     """
     if nc is None:
         nc = prediction.shape[2] - 5  if not kpt_label else prediction.shape[2] - 56 # number of classes
-    xc = prediction[..., 4] > conf_thres  # candidates
+    ci, ca = kpt_nms_candidates(prediction, conf_thres, max_candidates)  # image, anchor index of candidates
 
     # Settings
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
-    max_det = 300  # maximum number of detections per image
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
@@ -720,7 +720,7 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
     for xi, x in enumerate(prediction):  # image index, image inference
         # Apply constraints
         # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
+        x = x[ca[ci == xi]]  # confidence, top max_candidates by objectness
 
         # Cat apriori labels if autolabelling
         if labels and len(labels[xi]):
@@ -767,8 +767,6 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
         n = x.shape[0]  # number of boxes
         if not n:  # no boxes
             continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
 
         # Batched NMS
         c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
@@ -792,6 +790,79 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
     return output
 
 
+def kpt_nms_candidates(prediction, conf_thres=0.25, max_candidates=30000):
+    # Image and anchor index of NMS candidates: objectness above conf_thres, and when an image has more than
+    # max_candidates of those, only its top max_candidates by objectness. Reads the objectness column only.
+    obj = prediction[..., 4]
+    xc = obj > conf_thres
+    if max_candidates < obj.shape[1] and xc.sum(1).max() > max_candidates:
+        obj, ai = obj.topk(max_candidates, dim=1)  # pre-NMS top-k
+        xc = obj > conf_thres
+        bi = torch.arange(obj.shape[0], device=obj.device)[:, None].expand_as(ai)
+        return bi[xc], ai[xc]
+    return xc.nonzero(as_tuple=True)
+
+
+def non_max_suppression_kpt_batched(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                    nc=None, nkpt=None, max_candidates=30000, max_det=300):
+    """Runs Non-Maximum Suppression (NMS) on keypoint inference results for a whole batch at once
+
+    Candidates of all images go through a single torchvision.ops.nms() call with boxes offset by image index and
+    class, and the keypoint columns are gathered only for the boxes that survive.
+
+    Returns:
+         list of detections, on (n,6+3*nkpt) tensor per image [xyxy, conf, cls, kpts]
+    """
+    if nc is None:
+        nc = prediction.shape[2] - 5 - 3 * nkpt if nkpt is not None else prediction.shape[2] - 56  # number of classes
+    bs = prediction.shape[0]  # batch size
+
+    # Settings
+    max_wh = 4096  # (pixels) maximum box width and height
+
+    bi, ai = kpt_nms_candidates(prediction, conf_thres, max_candidates)  # image, anchor index of candidates
+    x = prediction[bi, ai, :5 + nc]  # box, obj and class columns of candidates
+
+    # Compute conf, best class only
+    conf, j = (x[:, 5:] * x[:, 4:5]).max(1)  # conf = obj_conf * cls_conf
+    keep = conf > conf_thres
+    if classes is not None:  # filter by class
+        keep &= (j[:, None] == torch.tensor(classes, device=j.device)).any(1)
+    bi, ai, x, conf, j = bi[keep], ai[keep], x[keep], conf[keep], j[keep]
+
+    # Batched NMS
+    box = xywh2xyxy(x[:, :4])
+    group = bi * nc + (0 if agnostic else j)  # boxes only suppress boxes of the same image (and class)
+    i = torchvision.ops.nms(box + group[:, None] * max_wh, conf, iou_thres)  # sorted by decreasing conf
+
+    # Limit detections per image, keeping them grouped by image in decreasing conf order
+    n = i.shape[0]
+    ii = bi[i]
+    order = torch.argsort(ii * n + torch.arange(n, device=i.device))
+    i, ii = i[order], ii[order]
+    counts = torch.bincount(ii, minlength=bs)
+    rank = torch.arange(n, device=i.device) - (torch.cumsum(counts, 0) - counts)[ii]  # position within its image
+    i = i[rank < max_det]
+
+    output = torch.cat((box[i], conf[i, None], j[i, None].float(), prediction[bi[i], ai[i], 5 + nc:]), 1)
+    return list(output.split(counts.clamp(max=max_det).tolist()))
+
+
+def file_hash(path):
+    # Returns the sha256 hex digest of a file's content, memoized per process on (path, size, mtime)
+    st = os.stat(path)
+    return _file_hash(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=32)
+def _file_hash(path, size, mtime):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def strip_optimizer(device='cpu',f='yolov7-w6-pose.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
@@ -181,6 +181,20 @@ class ConfusionMatrix:
             print(' '.join(map(str, self.matrix[i])))
 
 
+def keypoint_drift(ref, det, nkpt=17, iou_thres=0.5, kpt_thres=0.5):
+    # Pixel distance of det keypoints from ref keypoints, for (n, 6 + 3 * nkpt) detections [xyxy, conf, cls, kpts] of one
+    # image. Each ref person is matched to the det box of highest IoU (> iou_thres), only ref keypoints with
+    # conf > kpt_thres count. Returns (distances, ref persons, matched persons)
+    if not len(ref) or not len(det):
+        return torch.zeros(0), len(ref), 0
+    iou, j = general.box_iou(ref[:, :4], det[:, :4]).max(1)
+    matched = iou > iou_thres
+    k_ref = ref[matched, 6:].view(-1, nkpt, 3)
+    k_det = det[j[matched], 6:].view(-1, nkpt, 3)
+    visible = k_ref[..., 2] > kpt_thres
+    return (k_ref[..., :2] - k_det[..., :2]).norm(dim=-1)[visible], len(ref), int(matched.sum())
+
+
 # Plots ----------------------------------------------------------------------------------------------------------------
 
 def plot_pr_curve(px, py, ap, save_dir='pr_curve.png', names=()):
@@ -0,0 +1,240 @@
+# Threaded streaming pipeline utils
+
+import json
+import logging
+import queue
+from threading import Event, Thread
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STOP = object()  # end-of-stream sentinel, forwarded through every queue
+
+
+class Frame:
+    # Per-frame payload handed from stage to stage, stages attach their results as attributes
+    def __init__(self, index, image):
+        self.index = index  # position in the source stream
+        self.image = image  # original BGR frame
+
+
+class Stage(Thread):
+    # Worker thread that takes items from queue 'source', applies 'fn' and puts the result on every queue in 'sinks'.
+    # Queues are bounded, so a slow stage blocks the stages feeding it (backpressure). One worker per stage and FIFO
+    # queues keep frames in source order. With source=None, fn() is a producer and returns STOP at end of stream.
+    # fn may return None to consume an item without forwarding it (sinks). With batch_size set, fn receives a list of
+    # up to batch_size items (shorter at end of stream) and returns the list of results in the same order.
+    def __init__(self, name, fn, source=None, sinks=(), stop=None, batch_size=None):
+        super(Stage, self).__init__(name=name, daemon=True)
+        self.fn = fn
+        self.source = source
+        self.sinks = list(sinks)
+        self.stop = stop or Event()  # shared by all stages, set on error or user quit
+        self.batch_size = batch_size
+        self.error = None
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                if self.source is None:
+                    item = self.fn()
+                    if item is STOP:
+                        break
+                    self.forward(item)
+                elif self.batch_size:
+                    batch, done = self.get_batch()
+                    if batch:
+                        for item in self.fn(batch):
+                            self.forward(item)
+                    if done:
+                        break
+                else:
+                    item = self.get()
+                    if item is STOP:
+                        break
+                    self.forward(self.fn(item))
+        except Exception as e:
+            self.error = e
+            self.stop.set()  # unblock and wind down every other stage
+        finally:
+            for q in self.sinks:
+                self.put(q, STOP)
+
+    def forward(self, item):
+        if item is not None:
+            for q in self.sinks:
+                self.put(q, item)
+
+    def get_batch(self):
+        # Collect up to batch_size items, returns (items, end_of_stream)
+        batch = []
+        while len(batch) < self.batch_size:
+            item = self.get()
+            if item is STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def get(self):
+        # Blocking get that gives up once the pipeline is stopped
+        while not self.stop.is_set():
+            try:
+                return self.source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return STOP
+
+    def put(self, q, item):
+        # Blocking put that gives up once the pipeline is stopped
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if self.stop.is_set():
+                    return False
+
+
+def run_stages(stages):
+    # Start all stages on a shared stop event, wait for end of stream and re-raise the first stage error
+    stop = Event()
+    for s in stages:
+        s.stop = stop
+        s.start()
+    try:
+        for s in stages:
+            while s.is_alive():
+                s.join(timeout=0.5)  # short joins keep Ctrl+C responsive
+    except KeyboardInterrupt:
+        logger.info('Interrupted, stopping pipeline...')
+        stop.set()
+        for s in stages:
+            s.join()
+    for s in stages:
+        if s.error is not None:
+            raise RuntimeError(f'pipeline stage {s.name} failed') from s.error
+
+
+class KeypointWriter(Thread):
+    # Appends per-frame detections to a .jsonl file (one line per frame) or to a preallocated .npy memmap of shape
+    # (frames, max_persons, nkpt, 3) holding x, y, conf per keypoint, NaN where no person. Writing happens in this
+    # background thread behind an unbounded queue, so write() never blocks the caller.
+    def __init__(self, path, frames=None, max_persons=20, nkpt=17):
+        super(KeypointWriter, self).__init__(name='export', daemon=True)
+        self.path = str(path)
+        self.nkpt = nkpt
+        self.queue = queue.Queue()
+        self.error = None
+        self.dropped = 0  # frames beyond the memmap length
+        if self.path.endswith('.npy'):
+            assert frames and frames > 0, 'frame count unknown, use a .jsonl export for live sources'
+            self.file = None
+            self.array = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float32,
+                                                   shape=(frames, max_persons, nkpt, 3))
+            self.written = np.zeros(frames, dtype=bool)  # rows left unwritten get NaN in close()
+        else:
+            self.file = open(self.path, 'w')
+            self.array = None
+        self.start()
+
+    def write(self, index, pose):
+        # pose: (n, 6 + nkpt * 3) NMS output [xyxy, conf, cls, kpts] of frame 'index', any device
+        self.queue.put((index, pose))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                break
+            if self.error is not None:
+                continue  # keep draining so write() callers never pile up memory
+            try:
+                index, pose = item
+                pose = pose.detach().cpu().numpy()
+                if self.array is None:
+                    self.write_json(index, pose)
+                elif index < len(self.array):
+                    self.write_array(index, pose)
+                else:
+                    self.dropped += 1
+            except Exception as e:
+                self.error = e
+                logger.error(f'Keypoint export to {self.path} failed: {e}')
+
+    def write_json(self, index, pose):
+        persons = [{'box': p[:4].tolist(), 'conf': float(p[4]), 'cls': int(p[5]),
+                    'keypoints': p[6:].reshape(-1, 3).tolist()} for p in pose]
+        self.file.write(json.dumps({'frame': index, 'persons': persons}) + '\n')
+
+    def write_array(self, index, pose):
+        row = self.array[index]
+        row[:] = np.nan
+        n = min(len(pose), len(row))  # detections come sorted by confidence, the least confident are cut
+        row[:n] = pose[:n, 6:].reshape(n, self.nkpt, 3)
+        self.written[index] = True
+
+    def close(self):
+        # Flush everything queued so far and close the file, re-raises a write error
+        self.queue.put(STOP)
+        self.join()
+        if self.array is not None:
+            self.array[~self.written] = np.nan  # zero-filled by open_memmap, not a person at (0, 0)
+            self.array.flush()
+            if self.dropped:
+                logger.warning(f'{self.dropped} frames beyond the {len(self.array)} preallocated were not exported')
+        else:
+            self.file.close()
+        if self.error is not None:
+            raise RuntimeError(f'keypoint export to {self.path} failed') from self.error
+
+
+class LatencyController:
+    # Holds per-frame inference latency within 'budget' seconds on live sources. When the smoothed latency stays over
+    # budget for 'patience' frames, it steps the inference size down the ladder 'sizes' and, at the smallest size,
+    # starts skipping frames (up to max_skip of every max_skip + 1). When it stays under low * budget it undoes those
+    # steps in reverse order. The gap between budget and low * budget is the hysteresis. Every step is logged.
+    def __init__(self, sizes, budget, low=0.6, patience=5, max_skip=3, alpha=0.3):
+        self.sizes = sorted(set(sizes), reverse=True)  # largest first
+        self.budget, self.low, self.patience, self.max_skip, self.alpha = budget, low, patience, max_skip, alpha
+        self.level = 0  # index into sizes
+        self.skip = 0  # frames dropped after each processed one
+        self.latency = None  # exponential moving average
+        self.over = self.under = 0  # consecutive frames over budget / under low * budget
+        self.steps = 0
+
+    @property
+    def size(self):
+        return self.sizes[self.level]
+
+    def keep(self, index):
+        # Whether frame 'index' is processed at the current skip setting
+        return index % (self.skip + 1) == 0
+
+    def update(self, latency):
+        # Feed the measured latency of one processed frame, may change size or skip
+        self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+        self.over = self.over + 1 if self.latency > self.budget else 0
+        self.under = self.under + 1 if self.latency < self.low * self.budget else 0
+        if self.over >= self.patience:
+            if self.level < len(self.sizes) - 1:
+                self.step('over budget', level=self.level + 1)
+            elif self.skip < self.max_skip:
+                self.step('over budget', skip=self.skip + 1)
+        elif self.under >= self.patience:
+            if self.skip:
+                self.step('headroom', skip=self.skip - 1)
+            elif self.level:
+                self.step('headroom', level=self.level - 1)
+
+    def step(self, reason, level=None, skip=None):
+        old = self.describe()
+        self.level = self.level if level is None else level
+        self.skip = self.skip if skip is None else skip
+        self.over = self.under = 0
+        self.steps += 1
+        logger.info(f'Latency {self.latency * 1E3:.0f}ms, budget {self.budget * 1E3:.0f}ms, {reason}: '
+                    f'{old} -> {self.describe()}')
+
+    def describe(self):
+        return f'size {self.size}' + (f', 1 in {self.skip + 1} frames' if self.skip else '')
@@ -467,32 +467,42 @@ def plot_results(start=0, stop=0, bucket='', id=(), labels=(), save_dir=''):
     
     
 def output_to_keypoint(output):
-    # Convert model output to target format [batch_id, class_id, x, y, w, h, conf]
-    targets = []
-    for i, o in enumerate(output):
-        kpts = o[:,6:]
-        o = o[:,:6]
-        for index, (*box, conf, cls) in enumerate(o.cpu().numpy()):
-            targets.append([i, cls, *list(*xyxy2xywh(np.array(box)[None])), conf, *list(kpts.cpu().numpy()[index])])
-    return np.array(targets)
+    # Convert model output to target format [batch_id, class_id, x, y, w, h, conf, *kpts]
+    # Rows of the whole batch are assembled in one tensor op on the output device and copied to host once
+    if not len(output):
+        return np.zeros((0, 7), dtype=np.float32)
+    o = torch.cat(output)
+    n = torch.tensor([len(x) for x in output], device=o.device)
+    i = torch.repeat_interleave(torch.arange(len(output), device=o.device, dtype=o.dtype), n)  # image index per row
+    return torch.cat((i[:, None], o[:, 5:6], xyxy2xywh(o[:, :4]), o[:, 4:5], o[:, 6:]), 1).cpu().numpy()
+
+
+# COCO keypoint palette and skeleton, built once for plot_skeleton_kpts() and plot_skeletons()
+pose_palette = np.array([[255, 128, 0], [255, 153, 51], [255, 178, 102],
+                         [230, 230, 0], [255, 153, 255], [153, 204, 255],
+                         [255, 102, 255], [255, 51, 255], [102, 178, 255],
+                         [51, 153, 255], [255, 153, 153], [255, 102, 102],
+                         [255, 51, 51], [153, 255, 153], [102, 255, 102],
+                         [51, 255, 51], [0, 255, 0], [0, 0, 255], [255, 0, 0],
+                         [255, 255, 255]])
+pose_skeleton = np.array([[16, 14], [14, 12], [17, 15], [15, 13], [12, 13], [6, 12],
+                          [7, 13], [6, 7], [6, 8], [7, 9], [8, 10], [9, 11], [2, 3],
+                          [1, 2], [1, 3], [2, 4], [3, 5], [4, 6], [5, 7]]) - 1  # 0-based keypoint pairs
+pose_limb_color = pose_palette[[9, 9, 9, 9, 7, 7, 7, 0, 0, 0, 0, 0, 16, 16, 16, 16, 16, 16, 16]]
+pose_kpt_color = pose_palette[[16, 16, 16, 16, 16, 0, 0, 0, 0, 0, 0, 9, 9, 9, 9, 9, 9]]
+
+
+def _color_groups(colors):
+    # [(color tuple, indices drawn with that color), ...] so each color is one native draw call
+    return [(tuple(int(v) for v in c), np.flatnonzero((colors == c).all(1))) for c in np.unique(colors, axis=0)]
+
+
+pose_limb_groups = _color_groups(pose_limb_color)
+pose_kpt_groups = _color_groups(pose_kpt_color)
 
 
 def plot_skeleton_kpts(im, kpts, steps, orig_shape=None):
     #Plot the skeleton and keypointsfor coco datatset
-    palette = np.array([[255, 128, 0], [255, 153, 51], [255, 178, 102],
-                        [230, 230, 0], [255, 153, 255], [153, 204, 255],
-                        [255, 102, 255], [255, 51, 255], [102, 178, 255],
-                        [51, 153, 255], [255, 153, 153], [255, 102, 102],
-                        [255, 51, 51], [153, 255, 153], [102, 255, 102],
-                        [51, 255, 51], [0, 255, 0], [0, 0, 255], [255, 0, 0],
-                        [255, 255, 255]])
-
-    skeleton = [[16, 14], [14, 12], [17, 15], [15, 13], [12, 13], [6, 12],
-                [7, 13], [6, 7], [6, 8], [7, 9], [8, 10], [9, 11], [2, 3],
-                [1, 2], [1, 3], [2, 4], [3, 5], [4, 6], [5, 7]]
-
-    pose_limb_color = palette[[9, 9, 9, 9, 7, 7, 7, 0, 0, 0, 0, 0, 16, 16, 16, 16, 16, 16, 16]]
-    pose_kpt_color = palette[[16, 16, 16, 16, 16, 0, 0, 0, 0, 0, 0, 9, 9, 9, 9, 9, 9]]
     radius = 5
     num_kpts = len(kpts) // steps
 
@@ -506,13 +516,13 @@ def plot_skeleton_kpts(im, kpts, steps, orig_shape=None):
                     continue
             cv2.circle(im, (int(x_coord), int(y_coord)), radius, (int(r), int(g), int(b)), -1)
 
-    for sk_id, sk in enumerate(skeleton):
+    for sk_id, sk in enumerate(pose_skeleton):
         r, g, b = pose_limb_color[sk_id]
-        pos1 = (int(kpts[(sk[0]-1)*steps]), int(kpts[(sk[0]-1)*steps+1]))
-        pos2 = (int(kpts[(sk[1]-1)*steps]), int(kpts[(sk[1]-1)*steps+1]))
+        pos1 = (int(kpts[sk[0]*steps]), int(kpts[sk[0]*steps+1]))
+        pos2 = (int(kpts[sk[1]*steps]), int(kpts[sk[1]*steps+1]))
         if steps == 3:
-            conf1 = kpts[(sk[0]-1)*steps+2]
-            conf2 = kpts[(sk[1]-1)*steps+2]
+            conf1 = kpts[sk[0]*steps+2]
+            conf2 = kpts[sk[1]*steps+2]
             if conf1<0.5 or conf2<0.5:
                 continue
         if pos1[0]%640 == 0 or pos1[1]%640==0 or pos1[0]<0 or pos1[1]<0:
@@ -520,3 +530,36 @@ def plot_skeleton_kpts(im, kpts, steps, orig_shape=None):
         if pos2[0] % 640 == 0 or pos2[1] % 640 == 0 or pos2[0]<0 or pos2[1]<0:
             continue
         cv2.line(im, pos1, pos2, (int(r), int(g), int(b)), thickness=2)
+
+
+def plot_skeletons(im, kpts, steps=3, radius=5, thickness=2):
+    # Plot the skeletons of every person in a frame, kpts is an (n, nkpt * steps) array or tensor.
+    # Visibility follows plot_skeleton_kpts(), but masks and endpoints are computed for all persons at once and
+    # each color group is drawn with a single cv2.polylines() call. Keypoint dots are zero-length segments, which
+    # OpenCV renders as filled circles of radius thickness / 2.
+    if isinstance(kpts, torch.Tensor):
+        kpts = kpts.detach().cpu().numpy()  # one device-to-host copy per frame
+    if not len(kpts):
+        return im
+    kpts = np.asarray(kpts, dtype=np.float32).reshape(len(kpts), -1, steps)
+    xy = kpts[..., :2]
+    pts = xy.astype(np.int32)  # truncates like int()
+    conf = kpts[..., 2] >= 0.5 if steps == 3 else np.ones(pts.shape[:2], dtype=bool)
+
+    # Keypoints
+    visible = ~(xy % 640 == 0).any(-1) & conf  # (n, nkpt)
+    for color, ids in pose_kpt_groups:
+        p = pts[:, ids][visible[:, ids]]  # (m, 2)
+        if len(p):
+            cv2.polylines(im, list(np.stack((p, p), 1)), False, color, thickness=2 * radius)
+
+    # Limbs
+    valid = ~(pts % 640 == 0).any(-1) & (pts >= 0).all(-1) & conf  # (n, nkpt)
+    a, b = pose_skeleton[:, 0], pose_skeleton[:, 1]
+    drawn = valid[:, a] & valid[:, b]  # (n, nlimb)
+    segments = np.stack((pts[:, a], pts[:, b]), 2)  # (n, nlimb, 2, 2)
+    for color, ids in pose_limb_groups:
+        s = segments[:, ids][drawn[:, ids]]  # (m, 2, 2)
+        if len(s):
+            cv2.polylines(im, list(s), False, color, thickness=thickness)
+    return im
@@ -0,0 +1,108 @@
+# Post-training static INT8 quantization for CPU inference
+#
+# The fused backbone/neck (Conv, RepConv, Concat, MP, SPPCSPC, ReOrg, ... blocks of models/common.py) is quantized with
+# FX graph mode quantization and calibrated on frames sampled from the source. The IKeypoint head, its decode and NMS
+# stay in float: the backbone is traced with model.traced = True so it stops before the detect layer, as TracedModel
+# does. Ops without a quantized kernel (e.g. SiLU) are run in float by FX between dequantize/quantize pairs.
+
+import time
+from copy import deepcopy
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.datasets import LoadImages, letterbox, vid_formats
+from utils.general import non_max_suppression_kpt_batched
+from utils.metrics import keypoint_drift
+
+
+def calibration_frames(source, img_size=640, stride=64, n=32):
+    # Up to n letterboxed (1, 3, h, w) float frames spread evenly over image/video source. Videos are sampled by
+    # seeking to the chosen positions and image sources by picking files, so only those n frames are decoded
+    def to_input(img0):
+        img = letterbox(img0, img_size, stride=stride)[0]  # as LoadImages does
+        img = np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1))  # BGR to RGB, to 3xhxw
+        return torch.from_numpy(img).float()[None] / 255.0
+
+    frames = []
+    if Path(source).suffix[1:].lower() in vid_formats:
+        cap = cv2.VideoCapture(source)
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        for i in np.unique(np.linspace(0, max(total - 1, 0), n).round().astype(int)):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(i))
+            ret, img0 = cap.read()
+            if ret:
+                frames.append(to_input(img0))
+        cap.release()
+    else:
+        dataset = LoadImages(source, img_size=img_size, stride=stride)  # resolves files, dirs and globs
+        files = [f for f, video in zip(dataset.files, dataset.video_flag) if not video]
+        for i in np.unique(np.linspace(0, len(files) - 1, n).round().astype(int)) if files else []:
+            img0 = cv2.imread(files[i])  # BGR
+            if img0 is not None:
+                frames.append(to_input(img0))
+    assert frames, f'no calibration frames read from {source}'
+    return frames
+
+
+class Backbone(nn.Module):
+    # forward(x) of a Model without the augment/profile flags, which FX would trace as Proxies in control flow
+    def __init__(self, model):
+        super(Backbone, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.forward_once(x)
+
+
+class QuantizedModel(nn.Module):
+    # INT8 backbone + float detect layer of a fused eval-mode Model, calibrated on 'frames'
+    def __init__(self, model, frames, backend='fbgemm'):
+        super(QuantizedModel, self).__init__()
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        self.stride, self.names, self.yaml = model.stride, model.names, model.yaml
+        self.detect_layer = model.model[-1]
+        backbone = deepcopy(model).cpu().eval()
+        backbone.traced = True  # forward_once() stops before the detect layer
+        torch.backends.quantized.engine = backend
+        prepared = prepare_fx(Backbone(backbone), get_default_qconfig_mapping(backend), example_inputs=(frames[0],))
+        with torch.no_grad():
+            for x in frames:  # calibrate activation ranges
+                prepared(x)
+        self.backbone = convert_fx(prepared)
+
+    def forward(self, x, augment=False, profile=False):
+        return self.detect_layer(list(self.backbone(x)))
+
+
+@torch.no_grad()
+def quantization_report(model, qmodel, frames, conf_thres=0.25, iou_thres=0.65, kpt_thres=0.5):
+    # Compare fp32 'model' and INT8 'qmodel' on frames: throughput, matched persons and keypoint drift in pixels
+    nc, nkpt = model.yaml['nc'], model.yaml['nkpt']
+    results = {}
+    for name, m in ('fp32', model), ('int8', qmodel):
+        m(frames[0])  # warmup
+        t, out = time.time(), []
+        for x in frames:
+            out += non_max_suppression_kpt_batched(m(x)[0], conf_thres, iou_thres, nc=nc, nkpt=nkpt)
+        results[name] = out, len(frames) / (time.time() - t)
+
+    drift, n_ref, n_matched = [], 0, 0
+    for ref, det in zip(results['fp32'][0], results['int8'][0]):
+        d, n, m = keypoint_drift(ref, det, nkpt, kpt_thres=kpt_thres)
+        drift.append(d)
+        n_ref += n
+        n_matched += m
+    drift = torch.cat(drift) if drift else torch.zeros(0)
+
+    fps32, fps8 = results['fp32'][1], results['int8'][1]
+    print(f"INT8 vs fp32 on {len(frames)} frames: {fps32:.2f} -> {fps8:.2f} FPS ({fps8 / fps32:.2f}x), "
+          f"{n_matched}/{n_ref} persons matched, keypoint drift mean {drift.mean().item() if len(drift) else np.nan:.2f}px "
+          f"p95 {drift.quantile(0.95).item() if len(drift) else np.nan:.2f}px")
+    return {'fps_fp32': fps32, 'fps_int8': fps8, 'persons': n_ref, 'matched': n_matched,
+            'drift_mean': drift.mean().item() if len(drift) else np.nan}
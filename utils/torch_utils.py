@@ -6,6 +6,7 @@ import math
 import os
 import platform
 import subprocess
+import threading
 import time
 from contextlib import contextmanager
 from copy import deepcopy
@@ -357,7 +358,8 @@ class TracedModel(nn.Module):
         self.detect_layer = self.model.model[-1]
         self.model.traced = True
         
-        rand_example = torch.rand(1, 3, img_size, img_size)
+        h, w = (img_size, img_size) if isinstance(img_size, int) else img_size
+        rand_example = torch.rand(1, 3, h, w)
         
         traced_script_module = torch.jit.trace(self.model, rand_example, strict=False)
         #traced_script_module = torch.jit.script(self.model)
@@ -371,4 +373,95 @@ class TracedModel(nn.Module):
     def forward(self, x, augment=False, profile=False):
         out = self.model(x)
         out = self.detect_layer(out)
-        return out
\ No newline at end of file
+        return out
+
+class CachedTracedModel(nn.Module):
+    # TracedModel for serving: the traced backbone is loaded from cache_file when it exists, otherwise it is traced on
+    # a copy of the model in a background thread and saved there, while forward() runs the eager model. Batches
+    # smaller than the traced (b, 3, h, w) are padded to b, inputs of any other shape run eager. The detect layer
+    # always runs eager, as in TracedModel.
+    def __init__(self, model, shape, cache_file):
+        super(CachedTracedModel, self).__init__()
+        self.model = model
+        self.stride, self.names, self.yaml = model.stride, model.names, model.yaml
+        self.detect_layer = model.model[-1]
+        self.shape = torch.Size(shape)
+        self.cache_file = Path(cache_file)
+        self.device = next(model.parameters()).device
+        self.traced = None  # plain attribute, not a submodule, so the swap below is a single atomic dict store
+
+        if self.cache_file.exists():
+            self.__dict__['traced'] = torch.jit.load(str(self.cache_file), map_location=self.device)
+            logger.info(f'Loaded traced model {self.cache_file}')
+        else:
+            copy = deepcopy(model)  # taken here, before the eager model starts serving
+            copy.traced = True  # forward_once() stops before the detect layer
+            threading.Thread(target=self.trace, args=(copy,), name='trace', daemon=True).start()
+
+    def trace(self, model):
+        try:
+            t = time.time()
+            with torch.no_grad():
+                traced = torch.jit.trace(model, torch.rand(self.shape, device=self.device), strict=False)
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_file.with_suffix(f'.{os.getpid()}.tmp')
+            traced.save(str(tmp))
+            os.replace(tmp, self.cache_file)
+            self.__dict__['traced'] = traced
+            logger.info(f'Traced model in {time.time() - t:.1f}s, saved to {self.cache_file}')
+        except Exception as e:
+            logger.warning(f'Tracing failed, staying with the eager model: {e}')
+
+    def forward(self, x, augment=False, profile=False):
+        traced = self.traced
+        n = len(x)
+        if traced is None or n > self.shape[0] or x.shape[1:] != self.shape[1:]:
+            return self.model(x, augment, profile)
+        if n < self.shape[0]:  # short batch, e.g. the last one of a stream
+            x = torch.cat((x, x.new_zeros((self.shape[0] - n, *x.shape[1:]))))
+        return self.detect_layer([y[:n] for y in traced(x)])
+
+
+class PrecisionModel(nn.Module):
+    # Runs the backbone of a fused Model in channels_last layout and/or under bfloat16 autocast. The detect layer gets
+    # contiguous fp32 features, so IKeypoint decoding and NMS after it stay fp32. Converts 'model' in place.
+    def __init__(self, model, channels_last=True, bf16=False):
+        super(PrecisionModel, self).__init__()
+        self.model = model
+        self.stride, self.names, self.yaml = model.stride, model.names, model.yaml
+        self.detect_layer = model.model[-1]
+        self.channels_last, self.bf16 = channels_last, bf16
+        model.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+        self.detect_layer.to(memory_format=torch.contiguous_format)  # its view()s need contiguous outputs
+        model.traced = True  # forward_once() stops before the detect layer
+
+    @property
+    def mode(self):
+        return ('bf16' if self.bf16 else 'fp32') + (' channels_last' if self.channels_last else '')
+
+    def forward(self, x, augment=False, profile=False):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(x.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            features = self.model(x)
+        return self.detect_layer([f.float().contiguous() for f in features])
+
+
+@torch.no_grad()
+def precision_table(model, shape, runs=10):
+    # Print forward throughput of every precision/layout mode of PrecisionModel for input 'shape' (b, 3, h, w)
+    device = next(model.parameters()).device
+    x = torch.rand(shape, device=device)
+    print(f"{'mode':>20}{'ms/batch':>10}{'FPS':>8}{'speedup':>9}")
+    base = None
+    for channels_last, bf16 in (False, False), (True, False), (False, True), (True, True):
+        m = PrecisionModel(deepcopy(model), channels_last, bf16)
+        for _ in range(2):  # warmup
+            m(x)
+        t = time_synchronized()
+        for _ in range(runs):
+            m(x)
+        dt = (time_synchronized() - t) / runs
+        base = base or dt
+        print(f'{m.mode:>20}{dt * 1E3:>10.1f}{shape[0] / dt:>8.1f}{base / dt:>8.2f}x')
+        del m
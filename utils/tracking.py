@@ -0,0 +1,314 @@
+# Keyframe inference with optical-flow keypoint propagation, motion gating and ROI re-detection
+#
+# The pose network runs on keyframes only: every 'interval' frames, on a scene change, or once too few keypoints are
+# still confident. In between, the last detections are carried forward with sparse pyramidal Lucas-Kanade flow over
+# just their nkpt x persons points. Propagated keypoints lose a factor 'decay' of their confidence per frame, so they
+# age out below min_conf and force a re-detection. Detections stay in the (n, 6 + 3 * nkpt) [xyxy, conf, cls, kpts]
+# format of non_max_suppression_kpt() in source frame coordinates, as output_to_keypoint() and the writers expect.
+#
+# Usage (drift vs every-frame inference):
+#   $ python utils/tracking.py --weights yolov7-w6-pose.pt --source football1.mp4 --interval 5
+
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+import torchvision
+
+sys.path.append('./')  # to run '$ python *.py' files in subdirectories
+
+from utils.datasets import FrameTensor, letterbox_geometry
+from utils.metrics import keypoint_drift
+
+
+def frame_signature(image, size=(32, 18)):
+    # Tiny grayscale thumbnail of a BGR (or gray) frame as float32, cheap to compare between frames. The frame is
+    # strided down to about 4x the thumbnail first, so the cost hardly depends on the source resolution
+    s = max(min(image.shape[0] // (4 * size[1]), image.shape[1] // (4 * size[0])), 1)
+    thumb = cv2.resize(np.ascontiguousarray(image[::s, ::s]), size, interpolation=cv2.INTER_AREA)
+    return (cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY) if thumb.ndim == 3 else thumb).astype(np.float32)
+
+
+def signature_distance(a, b):
+    # Mean absolute difference of two frame_signature()s, in [0, 1]
+    return float(np.abs(a - b).mean()) / 255.0
+
+
+class KeypointPropagator:
+    # Decides per frame whether the network has to run and propagates the last detections when it does not.
+    # Call need_detection(image) for every frame, then either update(image, pose) with fresh detections or
+    # propagate(image) for the carried-forward ones.
+    def __init__(self, interval=5, decay=0.85, min_conf=0.3, scene_thres=0.15, win=21, levels=3, nkpt=17):
+        self.interval, self.decay, self.min_conf, self.scene_thres = interval, decay, min_conf, scene_thres
+        self.lk = dict(winSize=(win, win), maxLevel=levels,
+                       criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+        self.nkpt = nkpt
+        self.pose = None  # last (n, 6 + 3 * nkpt) detections, numpy float32
+        self.prev_gray = None
+        self.signature = None
+        self.since = 0  # frames since the last keyframe
+        self.confident = 0  # keypoints over min_conf at the last keyframe
+        self.keyframes = self.propagated = self.scene_changes = 0
+        self._image = self._gray = None
+
+    def gray(self, image):
+        # Grayscale of image, converted once per frame
+        if image is not self._image:
+            self._image, self._gray = image, cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    def need_detection(self, image):
+        # Whether the network has to run on 'image'
+        signature = frame_signature(self.gray(image))
+        scene_change = self.signature is not None and signature_distance(signature, self.signature) > self.scene_thres
+        self.signature = signature
+        self.scene_changes += scene_change
+        if self.pose is None or scene_change or self.since + 1 >= self.interval:
+            return True
+        confident = (self.pose[:, 8::3] > self.min_conf).sum()
+        return confident * 2 < self.confident  # half of the keyframe's confident keypoints aged out or were lost
+
+    def update(self, image, pose):
+        # Keyframe: fresh detections 'pose' (tensor, source frame coordinates) of 'image'
+        self.pose = pose.detach().cpu().float().numpy().copy()
+        self.prev_gray = self.gray(image)
+        self.since = 0
+        self.confident = (self.pose[:, 8::3] > self.min_conf).sum()
+        self.keyframes += 1
+
+    def propagate(self, image, device='cpu'):
+        # Detections of 'image' carried forward from the previous frame by optical flow, as a tensor on 'device'
+        gray = self.gray(image)
+        pose, nkpt = self.pose, self.nkpt
+        kpts = pose[:, 6:].reshape(-1, nkpt, 3)  # view, updated in place
+        live = kpts[..., 2] > 0
+        if live.any():
+            p0 = np.ascontiguousarray(kpts[live][:, :2]).reshape(-1, 1, 2)  # LK needs contiguous points
+            p1, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, p0, None, **self.lk)
+            p1 = p1.reshape(-1, 2)
+            h, w = gray.shape
+            ok = (status.ravel() == 1) & (p1[:, 0] >= 0) & (p1[:, 0] < w) & (p1[:, 1] >= 0) & (p1[:, 1] < h)
+            xy = kpts[..., :2]
+            moved = np.zeros_like(xy)
+            moved[live] = np.where(ok[:, None], p1 - p0.reshape(-1, 2), 0)
+            xy += moved
+            conf = kpts[..., 2]
+            tracked = live.copy()
+            tracked[live] = ok
+            conf[live & ~tracked] = 0  # lost
+            conf[tracked] *= self.decay
+
+            for i in range(len(pose)):  # boxes follow the median displacement of their tracked keypoints
+                if tracked[i].any():
+                    pose[i, [0, 2]] += np.median(moved[i, tracked[i], 0])
+                    pose[i, [1, 3]] += np.median(moved[i, tracked[i], 1])
+            pose[:, [0, 2]] = pose[:, [0, 2]].clip(0, w)
+            pose[:, [1, 3]] = pose[:, [1, 3]].clip(0, h)
+            pose[:, 6:] = kpts.reshape(len(pose), -1)  # no-op when reshape() gave a view
+        pose[:, 4] *= self.decay
+        self.prev_gray = gray
+        self.since += 1
+        self.propagated += 1
+        return torch.from_numpy(pose.copy()).to(device)
+
+    def describe(self):
+        n = self.keyframes + self.propagated
+        return (f'{self.keyframes}/{n} keyframes ({self.keyframes / max(n, 1):.1%}), {self.propagated} propagated, '
+                f'{self.scene_changes} scene changes')
+
+
+class MotionGate:
+    # Skips the network on (near) static frames: a frame whose frame_signature() differs from the last processed
+    # frame's by less than 'thres' reuses that frame's detections. The reference only moves on processed frames, so
+    # slow drift still adds up to a re-detection, and at most max_reuse frames in a row are gated
+    def __init__(self, thres=0.01, max_reuse=30, size=(32, 18)):
+        self.thres, self.max_reuse, self.size = thres, max_reuse, size
+        self.signature = None  # of the last processed frame
+        self.run = 0  # consecutive gated frames
+        self.frames = self.hits = 0
+        self.time = 0.  # spent deciding
+
+    def static(self, image):
+        # Whether 'image' can reuse the detections of the last processed frame
+        t = time.time()
+        signature = frame_signature(image, self.size)
+        hit = self.signature is not None and self.run < self.max_reuse and \
+            signature_distance(signature, self.signature) < self.thres
+        if hit:
+            self.run += 1
+        else:
+            self.signature, self.run = signature, 0
+        self.frames += 1
+        self.hits += hit
+        self.time += time.time() - t
+        return hit
+
+    def describe(self):
+        return (f'{self.hits}/{self.frames} frames reused ({self.hits / max(self.frames, 1):.1%}), '
+                f'{self.time / max(self.frames, 1) * 1E6:.0f}us per decision')
+
+
+class RoiDetector:
+    # Re-detection around known people: the previous frame's boxes, expanded by 'margin' of their size, are letterboxed
+    # into size x size crops that form one (n, 3, size, size) input batch. Detections are mapped back to the source
+    # frame the way scale_coords() undoes a letterbox, and duplicates of people seen by two overlapping crops are
+    # removed by NMS across crops. A full-frame pass runs every 'interval' frames to catch newcomers, and whenever
+    # nothing is tracked or more than max_rois people are. Crops are upscaled at most max_up times.
+    def __init__(self, device, size=320, margin=0.3, interval=10, max_rois=8, max_up=2.0, color=114):
+        self.size, self.margin, self.interval, self.max_rois, self.max_up = size, margin, interval, max_rois, max_up
+        self.color = color
+        self.tensor = FrameTensor((size, size), device, max_rois)  # crops are packed into slots 0..n-1
+        self.since = 0  # frames since the last full-frame pass
+        self.full = self.rois = self.crops = 0
+
+    def need_full(self, pose):
+        # Whether this frame needs a full-frame pass, given the previous frame's detections 'pose'
+        full = pose is None or not len(pose) or len(pose) > self.max_rois or self.since + 1 >= self.interval
+        self.since = 0 if full else self.since + 1
+        self.full += full
+        self.rois += not full
+        return full
+
+    def regions(self, boxes, shape):
+        # Integer (x1, y1, x2, y2) crop regions within a frame of 'shape' (h, w) around (n, 4) xyxy boxes
+        b = boxes.detach().cpu().float().numpy()
+        c, wh = (b[:, :2] + b[:, 2:4]) / 2, b[:, 2:4] - b[:, :2]
+        half = np.maximum(wh * (0.5 + self.margin), self.size / self.max_up / 2)  # expanded, upscaling bounded
+        lo = np.floor(np.maximum(c - half, 0)).astype(int)
+        hi = np.ceil(np.minimum(c + half, (shape[1], shape[0]))).astype(int)
+        return [(x1, y1, x2, y2) for (x1, y1), (x2, y2) in zip(lo, hi) if x2 > x1 and y2 > y1]
+
+    def batch(self, image, boxes):
+        # Crops of 'image' around 'boxes' as one input batch, returns (input, regions)
+        regions = self.regions(boxes, image.shape[:2])
+        for i, (x1, y1, x2, y2) in enumerate(regions):
+            _, (w, h), _, (top, _, left, _) = letterbox_geometry((y2 - y1, x2 - x1), self.size, auto=False)
+            slot = self.tensor.frames[i]
+            slot[:] = self.color
+            roi = slot[top:top + h, left:left + w]  # view, written in place
+            cv2.resize(image[y1:y2, x1:x2], (w, h), dst=roi, interpolation=cv2.INTER_LINEAR)
+            self.tensor(i)  # to float, written into self.tensor.out[i]
+        self.crops += len(regions)
+        return self.tensor.out[:len(regions)], regions
+
+    def merge(self, dets, regions, iou_thres=0.65):
+        # Per-crop detections (list of (n, 6 + 3 * nkpt) in crop input coordinates) to one (n, 6 + 3 * nkpt) tensor in
+        # source frame coordinates, without duplicates across crops
+        out = []
+        for d, (x1, y1, x2, y2) in zip(dets, regions):
+            (r, _), _, _, (top, _, left, _) = letterbox_geometry((y2 - y1, x2 - x1), self.size, auto=False)
+            for cols, pad, offset in ([0, 2], left, x1), ([1, 3], top, y1), (slice(6, None, 3), left, x1), \
+                    (slice(7, None, 3), top, y1):  # integer border where batch() placed the crop, as Letterboxer
+                d[:, cols] = (d[:, cols] - pad) / r + offset
+            out.append(d)
+        out = torch.cat(out)
+        return out[torchvision.ops.nms(out[:, :4], out[:, 4], iou_thres)]
+
+    def describe(self, full_pixels):
+        # Pass counts and the ROI input size relative to 'full_pixels', the full-frame input pixels
+        share = self.crops * self.size ** 2 / max(self.rois * full_pixels, 1)
+        return (f'{self.full} full-frame and {self.rois} ROI passes, {self.crops / max(self.rois, 1):.1f} crops per '
+                f'ROI pass, ROI passes at {share:.1%} of the full-frame input pixels')
+
+
+def check_propagator(shift=(3, 2), persons=2, nkpt=17, seed=0):
+    # Propagate random keypoints from a textured synthetic frame to a copy shifted by 'shift' (x, y) pixels, returns
+    # whether the tracked keypoints moved by that shift (within 0.5px) and the boxes followed
+    rng = np.random.default_rng(seed)
+    frame = cv2.GaussianBlur(rng.integers(0, 256, (240, 320, 3), dtype=np.uint8), (5, 5), 0)
+    moved = np.roll(frame, shift[::-1], axis=(0, 1))
+    pose = np.zeros((persons, 6 + 3 * nkpt), dtype=np.float32)
+    pose[:, 6:].reshape(persons, nkpt, 3)[..., :2] = rng.uniform(40, 200, (persons, nkpt, 2))
+    pose[:, 8::3] = 0.9
+    pose[:, :4] = 30, 30, 220, 220
+    pose[:, 4] = 0.9
+
+    propagator = KeypointPropagator(nkpt=nkpt)
+    assert propagator.need_detection(frame)
+    propagator.update(frame, torch.from_numpy(pose))
+    out = propagator.propagate(moved).numpy()
+    kept = out[:, 8::3] > 0
+    dx, dy = out[:, 6::3] - pose[:, 6::3], out[:, 7::3] - pose[:, 7::3]
+    error = max(np.abs(dx[kept] - shift[0]).max(), np.abs(dy[kept] - shift[1]).max()) if kept.any() else np.inf
+    ok = kept.mean() > 0.9 and error < 0.5 and np.allclose(out[:, :4] - pose[:, :4], [*shift, *shift], atol=0.5)
+    print(f'KeypointPropagator check: {kept.sum()}/{kept.size} keypoints tracked, shift error up to {error:.3f}px, '
+          f'{"ok" if ok else "FAILED"}')
+    return ok
+
+
+@torch.no_grad()
+def drift_report(weights, source, img_size=960, interval=5, decay=0.85, min_conf=0.3, device='cpu', frames=0,
+                 conf_thres=0.25, iou_thres=0.65):
+    # Run the network on every frame of 'source' as the reference and a KeypointPropagator alongside it, then print
+    # keypoint drift (px) of the propagated frames against the reference and the share of frames that needed the network
+    from models.experimental import attempt_load
+    from utils.datasets import Letterboxer
+    from utils.general import check_img_size, clip_coords, non_max_suppression_kpt_batched
+    from utils.torch_utils import select_device
+
+    device = select_device(device)
+    model = attempt_load(weights, map_location=device).eval()
+    nc, nkpt = model.yaml['nc'], model.yaml['nkpt']
+    gs = int(model.stride.max())
+    cap = cv2.VideoCapture(source)
+    propagator = KeypointPropagator(interval, decay, min_conf, nkpt=nkpt)
+    letterboxer = None
+    drift, n_ref, n_matched, t_net, t_flow = [], 0, 0, 0., 0.
+    while cap.isOpened() and (not frames or propagator.keyframes + propagator.propagated < frames):
+        ret, image = cap.read()
+        if not ret:
+            break
+        if letterboxer is None:
+            letterboxer = Letterboxer(image.shape, check_img_size(img_size, s=gs), stride=gs, auto=True)
+        t = time.time()
+        im = letterboxer(image)[..., ::-1].transpose(2, 0, 1)  # BGR HWC to RGB CHW
+        im = torch.from_numpy(np.ascontiguousarray(im)).to(device).float()[None] / 255.0
+        ref = non_max_suppression_kpt_batched(model(im)[0], conf_thres, iou_thres, nc=nc, nkpt=nkpt)[0]
+        letterboxer.inverse(ref[:, :4])
+        letterboxer.inverse(ref[:, 6:], steps=3)
+        clip_coords(ref, letterboxer.shape)
+        dt = time.time() - t
+
+        t = time.time()
+        if propagator.need_detection(image):
+            propagator.update(image, ref)
+            t_net += dt
+        else:
+            pose = propagator.propagate(image, ref.device)
+            d, n, m = keypoint_drift(ref, pose, nkpt)
+            drift.append(d)
+            n_ref += n
+            n_matched += m
+        t_flow += time.time() - t
+    cap.release()
+
+    drift = torch.cat(drift).cpu() if drift else torch.zeros(0)
+    n = propagator.keyframes + propagator.propagated
+    mean = drift.mean().item() if len(drift) else np.nan
+    p95 = drift.quantile(0.95).item() if len(drift) else np.nan
+    print(f'{source}: {propagator.describe()}')
+    print(f'Propagated frames: {n_matched}/{n_ref} persons matched, keypoint drift mean {mean:.2f}px p95 {p95:.2f}px')
+    print(f'Time per frame: network {t_net / max(propagator.keyframes, 1) * 1E3:.1f}ms on keyframes, '
+          f'keyframe decision + flow {t_flow / max(n, 1) * 1E3:.1f}ms')
+    return {'frames': n, 'keyframes': propagator.keyframes, 'persons': n_ref, 'matched': n_matched,
+            'drift_mean': mean, 'drift_p95': p95}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='yolov7-w6-pose.pt', help='model.pt path')
+    parser.add_argument('--source', type=str, default='football1.mp4', help='video')
+    parser.add_argument('--img-size', type=int, default=960, help='inference size (pixels)')
+    parser.add_argument('--interval', type=int, default=5, help='run the network at least every N frames')
+    parser.add_argument('--decay', type=float, default=0.85, help='keypoint confidence factor per propagated frame')
+    parser.add_argument('--min-conf', type=float, default=0.3, help='keypoints below this confidence count as aged out')
+    parser.add_argument('--frames', type=int, default=0, help='stop after N frames, 0 for the whole video')
+    parser.add_argument('--device', type=str, default='cpu', help='cpu/0,1,2,3(gpu)')
+    parser.add_argument('--check', action='store_true', help='only check propagation on synthetic frames')
+    opt = parser.parse_args()
+    if opt.check:
+        sys.exit(0 if check_propagator() else 1)
+    drift_report(opt.weights, opt.source, opt.img_size, opt.interval, opt.decay, opt.min_conf, opt.device, opt.frames)